@@ -1,13 +1,78 @@
 # This work is licensed under the GNU GPLv2 or later.
 # See the COPYING file in the top-level directory.
 
+import copy
+import json
 from logging import getLogger
+import threading
 
 import requests
 
+from ._session import _HTTPAdapterRegistry
+
 log = getLogger(__name__)
 
 
+class _SingleFlight(object):
+    """
+    Coalesce identical read calls running at the same time. The first
+    caller of a key (the leader) does the call, the others wait for it
+    and get a deep copy of its result, or the same exception.
+
+    The followers copy a snapshot taken before the leader returns,
+    since its caller is free to modify the result right away.
+    """
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.followers = 0
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Key of a call, the same for equal params in any dict order
+        """
+        return json.dumps(parts, sort_keys=True, default=repr)
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._Call()
+                self._calls[key] = call
+            else:
+                call.followers += 1
+
+        if not leader:
+            log.debug("Waiting for in-flight call %s", key)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        result = None
+        try:
+            result = func()
+            return result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                # No follower can join once the key is gone
+                del self._calls[key]
+            if call.followers and call.error is None:
+                call.result = copy.deepcopy(result)
+            call.done.set()
+
+
 class _BackendBase(object):
     """
     Backends are thin wrappers around the different bugzilla API paradigms
@@ -17,12 +82,14 @@ class _BackendBase(object):
     def __init__(self, url, bugzillasession):
         self._url = url
         self._bugzillasession = bugzillasession
+        self._singleflight = _SingleFlight()
 
 
     @staticmethod
     def probe(url):
         try:
-            requests.head(url, timeout=10).raise_for_status()
+            session = _HTTPAdapterRegistry.mount(requests.Session(), url)
+            session.head(url, timeout=10).raise_for_status()
             return True  # pragma: no cover
         except Exception as e:
             log.debug("Failed to probe url=%s : %s", url, str(e))
@@ -51,6 +118,24 @@ class _BackendBase(object):
         """
         return False
 
+    def batch(self, calls):
+        """
+        Run many independent API calls, in as few requests as the
+        backend allows. This default just runs them one by one.
+
+        :param calls: list of (methodname, args) tuples, like
+            ("bug_get", ([1234], [], {})) for self.bug_get([1234], [], {})
+        :returns: list with, for each call, its result or the
+            exception it raised
+        """
+        ret = []
+        for methodname, args in calls:
+            try:
+                ret.append(getattr(self, methodname)(*args))
+            except Exception as e:
+                ret.append(e)
+        return ret
+
 
     ######################
     # Bugzilla info APIs #
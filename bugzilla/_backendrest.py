@@ -2,6 +2,7 @@
 # See the COPYING file in the top-level directory.
 
 import base64
+import concurrent.futures
 import json
 import logging
 import os
@@ -62,6 +63,14 @@ class _BackendREST(_BackendBase):
         return ret
 
     def _op(self, method, apiurl, paramdict=None):
+        if method == "GET":
+            # Identical GETs in flight at the same time share one request
+            return self._singleflight.do(
+                self._singleflight.make_key(apiurl, paramdict),
+                lambda: self._op_uncoalesced(method, apiurl, paramdict))
+        return self._op_uncoalesced(method, apiurl, paramdict)
+
+    def _op_uncoalesced(self, method, apiurl, paramdict=None):
         fullurl = os.path.join(self._url, apiurl.lstrip("/"))
         log.debug("Bugzilla REST %s %s params=%s", method, fullurl, paramdict)
 
@@ -89,6 +98,23 @@ class _BackendREST(_BackendBase):
         return self._op("POST", *args, **kwargs)
 
 
+    def _fanout(self, apiurl, ids, paramdict):
+        """
+        GET apiurl % id for every id, with at most get_concurrency()
+        requests in flight, and return the results in the order of ids.
+        For the endpoints where REST, unlike XMLRPC, takes one id only.
+        """
+        ids = listify(ids) or []
+        def _get_one(oneid):
+            return self._get(apiurl % oneid, paramdict)
+
+        workers = min(self._bugzillasession.get_concurrency(), len(ids))
+        if workers <= 1:
+            return [_get_one(oneid) for oneid in ids]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="bzrest") as pool:
+            return list(pool.map(_get_one, ids))
+
     #######################
     # API implementations #
     #######################
@@ -99,6 +125,19 @@ class _BackendREST(_BackendBase):
     def is_rest(self):
         return True
 
+    def batch(self, calls):
+        # REST has no multicall, but the calls can at least be
+        # sent concurrently
+        def _call_one(call):
+            return _BackendBase.batch(self, [call])[0]
+
+        workers = min(self._bugzillasession.get_concurrency(), len(calls))
+        if workers <= 1:
+            return _BackendBase.batch(self, calls)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="bzrest") as pool:
+            return list(pool.map(_call_one, calls))
+
     def bugzilla_version(self):
         return self._get("/version")
 
@@ -129,8 +168,8 @@ class _BackendREST(_BackendBase):
     def bug_attachment_get(self, attachment_ids, paramdict):
         # XMLRPC supported mutiple fetch at once, but not REST
         ret = {}
-        for attid in listify(attachment_ids):
-            out = self._get("/bug/attachment/%s" % attid, paramdict)
+        for out in self._fanout("/bug/attachment/%s",
+                                attachment_ids, paramdict):
             _update_key(ret, out, "attachments")
             _update_key(ret, out, "bugs")
         return ret
@@ -138,8 +177,7 @@ class _BackendREST(_BackendBase):
     def bug_attachment_get_all(self, bug_ids, paramdict):
         # XMLRPC supported mutiple fetch at once, but not REST
         ret = {}
-        for bugid in listify(bug_ids):
-            out = self._get("/bug/%s/attachment" % bugid, paramdict)
+        for out in self._fanout("/bug/%s/attachment", bug_ids, paramdict):
             _update_key(ret, out, "attachments")
             _update_key(ret, out, "bugs")
         return ret
@@ -158,15 +196,13 @@ class _BackendREST(_BackendBase):
     def bug_comments(self, bug_ids, paramdict):
         # XMLRPC supported mutiple fetch at once, but not REST
         ret = {}
-        for bugid in bug_ids:
-            out = self._get("/bug/%s/comment" % bugid, paramdict)
+        for out in self._fanout("/bug/%s/comment", bug_ids, paramdict):
             _update_key(ret, out, "bugs")
         return ret
     def bug_history(self, bug_ids, paramdict):
         # XMLRPC supported mutiple fetch at once, but not REST
         ret = {"bugs": []}
-        for bugid in bug_ids:
-            out = self._get("/bug/%s/history" % bugid, paramdict)
+        for out in self._fanout("/bug/%s/history", bug_ids, paramdict):
             ret["bugs"].extend(out.get("bugs", []))
         return ret
 
@@ -1,8 +1,10 @@
 # This work is licensed under the GNU GPLv2 or later.
 # See the COPYING file in the top-level directory.
 
+import copy
 from logging import getLogger
 import sys
+import threading
 from xmlrpc.client import (Binary, Fault, ProtocolError,
                            ServerProxy, Transport)
 
@@ -16,6 +18,31 @@ from ._util import listify
 log = getLogger(__name__)
 
 
+# XMLRPC methods that don't change anything on the server, so
+# can be retried safely
+_READ_ONLY_METHODS = [
+    "Bug.attachments", "Bug.comments", "Bug.fields", "Bug.get",
+    "Bug.history", "Bug.legal_values", "Bug.search",
+    "Bugzilla.extensions", "Bugzilla.time", "Bugzilla.timezone",
+    "Bugzilla.version", "Component.get", "Group.get",
+    "Product.get", "Product.get_accessible_products",
+    "Product.get_enterable_products", "Product.get_selectable_products",
+    "User.get", "User.valid_login",
+]
+
+
+def _is_read_only_method(methodname, params):
+    """
+    Whether the XMLRPC call only reads data, for system.multicall
+    whether all its calls do
+    """
+    if methodname == "system.multicall":
+        return bool(params) and all(
+            call.get("methodName") in _READ_ONLY_METHODS
+            for call in params[0])
+    return methodname in _READ_ONLY_METHODS
+
+
 class _BugzillaXMLRPCTransport(Transport):
     def __init__(self, bugzillasession):
         if hasattr(Transport, "__init__"):
@@ -24,11 +51,21 @@ class _BugzillaXMLRPCTransport(Transport):
         self.__bugzillasession = bugzillasession
         self.__bugzillasession.set_xmlrpc_defaults()
         self.__seen_valid_xml = False
+        # Set by the proxy before each call. Per thread, since
+        # concurrent callers share the proxy and its transport
+        self.__callinfo = threading.local()
 
         # Override Transport.user_agent
         self.user_agent = self.__bugzillasession.get_user_agent()
 
 
+    def set_idempotent(self, idempotent):
+        """
+        Whether the next request of this thread may be retried
+        """
+        self.__callinfo.idempotent = idempotent
+
+
     ############################
     # Bugzilla private helpers #
     ############################
@@ -42,7 +79,8 @@ class _BugzillaXMLRPCTransport(Transport):
         # pylint: disable=raise-missing-from
         try:
             response = self.__bugzillasession.request(
-                "POST", url, data=request_body)
+                "POST", url, data=request_body,
+                idempotent=getattr(self.__callinfo, "idempotent", False))
 
             return self.parse_response(response)
         except RequestException as e:
@@ -105,28 +143,74 @@ class _BugzillaXMLRPCProxy(ServerProxy, object):
     Override of xmlrpc ServerProxy, to insert bugzilla API auth
     into the XMLRPC request data
     """
-    def __init__(self, uri, bugzillasession, *args, **kwargs):
+    def __init__(self, uri, bugzillasession, singleflight=None,
+                 *args, **kwargs):
         self.__bugzillasession = bugzillasession
-        transport = _BugzillaXMLRPCTransport(self.__bugzillasession)
-        ServerProxy.__init__(self, uri, transport, *args, **kwargs)
+        self.__singleflight = singleflight
+        self.__transport = _BugzillaXMLRPCTransport(self.__bugzillasession)
+        ServerProxy.__init__(self, uri, self.__transport, *args, **kwargs)
 
     def _ServerProxy__request(self, methodname, params):
         """
         Overrides ServerProxy _request method
         """
+        if self.__singleflight and _is_read_only_method(methodname, params):
+            # Identical reads in flight at the same time share one request
+            return self.__singleflight.do(
+                self.__singleflight.make_key(methodname, params),
+                lambda: self.__request(methodname, params))
+        return self.__request(methodname, params)
+
+    def __request(self, methodname, params):
+        if methodname == "system.multicall":
+            # Auth goes into each of the batched calls instead
+            newcalls = []
+            for call in params[0]:
+                newcall = call.copy()
+                newcall["params"] = [self.__add_auth_params(call["params"])]
+                newcalls.append(newcall)
+            log.debug("XMLRPC multicall: %s",
+                      [call["methodName"] for call in newcalls])
+            newparams = (newcalls,)
+        else:
+            log.debug("XMLRPC call: %s(%s)",
+                      methodname, params and params[0] or {})
+            newparams = (self.__add_auth_params(params),)
+
+        self.__transport.set_idempotent(
+            _is_read_only_method(methodname, params))
+        # pylint: disable=no-member
+        ret = ServerProxy._ServerProxy__request(
+            self, methodname, newparams)
+        # pylint: enable=no-member
+
+        return ret
+
+    def __add_auth_params(self, params):
         # params is a singleton tuple, enforced by xmlrpc.client.dumps
         newparams = params and params[0].copy() or {}
-
-        log.debug("XMLRPC call: %s(%s)", methodname, newparams)
         authparams = self.__bugzillasession.get_auth_params()
         authparams.update(newparams)
+        return authparams
 
-        # pylint: disable=no-member
-        ret = ServerProxy._ServerProxy__request(
-            self, methodname, (authparams,))
-        # pylint: enable=no-member
 
-        return ret
+class _XMLRPCCallRecorder(object):
+    """
+    Stand-in for the XMLRPC proxy which only records the calls
+    made through it, to be sent later in a system.multicall
+    """
+    def __init__(self, calls, methodname=None):
+        self.__calls = calls
+        self.__methodname = methodname
+
+    def __getattr__(self, name):
+        if self.__methodname:
+            name = "%s.%s" % (self.__methodname, name)
+        return _XMLRPCCallRecorder(self.__calls, name)
+
+    def __call__(self, *params):
+        self.__calls.append({"methodName": self.__methodname,
+                             "params": list(params)})
 
 
 class _BackendXMLRPC(_BackendBase):
@@ -135,13 +219,51 @@ class _BackendXMLRPC(_BackendBase):
     """
     def __init__(self, url, bugzillasession):
         _BackendBase.__init__(self, url, bugzillasession)
-        self._xmlrpc_proxy = _BugzillaXMLRPCProxy(url, self._bugzillasession)
+        self._xmlrpc_proxy = _BugzillaXMLRPCProxy(url, self._bugzillasession,
+                                                  self._singleflight)
+        self._multicall_supported = None
 
     def get_xmlrpc_proxy(self):
         return self._xmlrpc_proxy
     def is_xmlrpc(self):
         return True
 
+    def batch(self, calls):
+        """
+        Send all calls in one system.multicall request, falling back
+        to one request per call if the server doesn't support it
+        """
+        if len(calls) <= 1 or self._multicall_supported is False:
+            return _BackendBase.batch(self, calls)
+
+        # Every backend method makes exactly one proxy call,
+        # so record them on a copy of ourselves to get the
+        # XMLRPC method names and params
+        recorded = []
+        recorder = copy.copy(self)
+        recorder._xmlrpc_proxy = _XMLRPCCallRecorder(recorded)
+        for methodname, args in calls:
+            getattr(recorder, methodname)(*args)
+        if len(recorded) != len(calls):  # pragma: no cover
+            return _BackendBase.batch(self, calls)
+
+        try:
+            results = self._xmlrpc_proxy.system.multicall(recorded)
+        except Fault as e:
+            log.debug("system.multicall failed, falling back to "
+                      "single calls: %s", e)
+            self._multicall_supported = False
+            return _BackendBase.batch(self, calls)
+        self._multicall_supported = True
+
+        ret = []
+        for result in results:
+            if isinstance(result, dict) and "faultCode" in result:
+                ret.append(Fault(result["faultCode"], result["faultString"]))
+            else:
+                ret.append(result[0])
+        return ret
+
     def bugzilla_version(self):
         return self._xmlrpc_proxy.Bugzilla.version()
 
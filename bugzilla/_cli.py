@@ -11,6 +11,7 @@
 
 import argparse
 import base64
+import collections.abc
 import datetime
 import errno
 import json
@@ -327,6 +328,15 @@ def _setup_action_query_parser(subparsers):
         help="Owner ID of the --savedsearch. You can get this ID from "
             "the URL bugzilla generates when running the saved search "
             "from the web UI.")
+    g.add_argument('--page-size', type=int, metavar="N",
+        help="Fetch the results in pages of N bugs, ordered by bug ID, "
+             "instead of a single search. Use this for huge result sets "
+             "that hit the server's result cap or timeout.")
+    g.add_argument('--split-by', choices=["id", "creation_time"],
+        help="Run the query as many smaller concurrent ones over bug ID "
+             "ranges or creation time windows, splitting further the "
+             "ones that time out. Use this for huge queries that die "
+             "with server timeouts.")
 
     # Keep this at the end so it sticks out more
     g.add_argument('--from-url', metavar="WEB_QUERY_URL",
@@ -511,7 +521,10 @@ def _do_get(bz, opt):
     return buglist
 
 
-def _do_query(bz, opt, parser):
+def _build_query(bz, opt, parser):
+    """
+    Turn the 'query' options into a query dict for bz.query()
+    """
     q = {}
 
     # Parse preconstructed queries.
@@ -672,7 +685,21 @@ def _do_query(bz, opt, parser):
 
     if not q:  # pragma: no cover
         parser.error("'query' command requires additional arguments")
-    return bz.query(q)
+    return q
+
+
+def _do_query(bz, opt, parser):
+    query = _build_query(bz, opt, parser)
+    if opt.split_by:
+        if opt.page_size is not None:
+            parser.error("--split-by and --page-size can't be combined")
+        return bz.query_split(query, split_by=opt.split_by)
+    if opt.page_size is None:
+        return bz.query(query)
+    if opt.page_size < 1:
+        parser.error("--page-size must be a positive number")
+    return list(bz.query_iter(query, page_size=opt.page_size,
+                              readahead=True))
 
 
 def _do_info(bz, opt):
@@ -764,6 +791,9 @@ def _convert_to_outputformat(output):
 
 
 def _xmlrpc_converter(obj):
+    if isinstance(obj, collections.abc.Mapping):
+        # Bug.get_raw_data_view()
+        return dict(obj)
     if "DateTime" in str(obj.__class__):
         # xmlrpc DateTime object. Convert to date format that
         # bugzilla REST API outputs
@@ -777,7 +807,7 @@ def _xmlrpc_converter(obj):
 
 
 def _format_output_json(buglist):
-    out = {"bugs": [b.get_raw_data() for b in buglist]}
+    out = {"bugs": [b.get_raw_data_view() for b in buglist]}
     s = json.dumps(out, default=_xmlrpc_converter, indent=2, sort_keys=True)
     print(s)
 
@@ -786,12 +816,13 @@ def _format_output_raw(buglist):
     for b in buglist:
         print("Bugzilla %s: " % b.bug_id)
         SKIP_NAMES = ["bugzilla"]
-        for attrname in sorted(b.__dict__):
+        attrs = b._get_attributes()
+        for attrname in sorted(attrs):
             if attrname in SKIP_NAMES:
                 continue
             if attrname.startswith("_"):
                 continue
-            print("ATTRIBUTE[%s]: %s" % (attrname, b.__dict__[attrname]))
+            print("ATTRIBUTE[%s]: %s" % (attrname, attrs[attrname]))
         print("\n\n")
 
 
@@ -825,12 +856,12 @@ def _bug_field_repl_cb(bz, b, matchobj):
 
     elif fieldname == "cve":
         cves = []
-        for key in getattr(b, "keywords", []):
-            # grab CVE from keywords and blockers
-            if key.find("Security") == -1:
-                continue
-            for bl in b.blocks:
-                cvebug = bz.getbug(bl)
+        # grab CVE from keywords and blockers
+        if [key for key in getattr(b, "keywords", [])
+                if key.find("Security") != -1]:
+            for cvebug in bz.getbugs_batch(b.blocks):
+                if isinstance(cvebug, Exception):
+                    raise cvebug
                 for cb in cvebug.alias:
                     if (cb.find("CVE") != -1 and
                         cb.strip() not in cves):
@@ -881,8 +912,7 @@ def _format_output(bz, opt, buglist):
                 extra_fields=extra_fields)
         
         if opt.with_comment:
-            for b in buglist:
-                b.getcomments_attr()
+            bz.get_comments_attr(buglist)
 
         if opt.output == 'json':
             _format_output_json(buglist)
@@ -890,9 +920,9 @@ def _format_output(bz, opt, buglist):
             _format_output_raw(buglist)
         return
 
+    if opt.with_comment:
+        bz.get_comments_attr(buglist)
     for b in buglist:
-        if opt.with_comment:
-            b.getcomments_attr()
         # pylint: disable=cell-var-from-loop
         def cb(matchobj):
             return _bug_field_repl_cb(bz, b, matchobj)
@@ -0,0 +1,193 @@
+# This work is licensed under the GNU GPLv2 or later.
+# See the COPYING file in the top-level directory.
+
+import hashlib
+import json
+import os
+from logging import getLogger
+import tempfile
+import threading
+import time
+
+from ._authfiles import _default_cache_location, _makedirs
+
+log = getLogger(__name__)
+
+
+class _BugzillaMetadataCache(object):
+    """
+    Helper class for the optional on-disk cache of API metadata like
+    products, component names and bug fields.
+
+    Every bugzilla URL gets its own JSON file in the cache directory.
+    Each entry carries the time it was stored, so it expires after
+    `ttl` seconds, and the whole file is dropped when the server
+    version changes.
+    """
+    @staticmethod
+    def get_default_path():
+        return _default_cache_location("metadata")
+
+    def __init__(self, path, url, ttl):
+        self._url = url
+        self._ttl = ttl
+        self._filename = os.path.join(os.path.expanduser(path),
+            hashlib.sha256(url.encode("utf-8")).hexdigest()[:32] + ".json")
+        self._lock = threading.Lock()
+        self._version = None
+        self._entries = {}
+
+    def get_filename(self):
+        return self._filename
+
+    def load(self, version):
+        """
+        Read the cache file of our URL. Entries stored for another
+        server version are discarded.
+        """
+        data = {}
+        try:
+            with open(self._filename, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.debug("Ignoring unreadable metadata cache %s: %s",
+                      self._filename, e)
+
+        with self._lock:
+            self._version = version
+            self._entries = {}
+            if data.get("url") != self._url:
+                return
+            if data.get("version") != version:
+                log.debug("Bugzilla version changed from %s to %s, "
+                          "dropping metadata cache", data.get("version"),
+                          version)
+                return
+            self._entries = data.get("entries") or {}
+
+    def get(self, name):
+        """
+        Return the value stored for `name`, or None if it is
+        missing or older than the ttl
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+        if not entry:
+            return None
+        if time.time() - entry["time"] > self._ttl:
+            log.debug("Metadata cache entry '%s' expired", name)
+            return None
+        return entry["value"]
+
+    def get_time(self, name):
+        """
+        Return the time `name` was stored, or None if it is missing
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+        return entry and entry["time"]
+
+    def set(self, name, value):
+        self.update({name: value})
+
+    def update(self, values):
+        """
+        Store every name: value of the values dict, writing the
+        file only once
+        """
+        now = time.time()
+        with self._lock:
+            for name, value in values.items():
+                self._entries[name] = {"time": now, "value": value}
+            self._write()
+
+    def delete(self, name):
+        with self._lock:
+            if self._entries.pop(name, None) is not None:
+                self._write()
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._write()
+
+    def _write(self):
+        data = {"url": self._url, "version": self._version,
+                "entries": self._entries}
+        try:
+            _makedirs(self._filename)
+            fd, tmpname = tempfile.mkstemp(
+                dir=os.path.dirname(self._filename), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmpname, self._filename)
+        except Exception as e:  # pragma: no cover
+            log.debug("Failed to write metadata cache %s: %s",
+                      self._filename, e)
+
+
+class _BugzillaConnectCache(object):
+    """
+    Process-wide cache of what connect() learns about a URL: the
+    backend and fixed URL found by probing a bare hostname, and the
+    server version. Entries are kept in memory, and also on disk
+    when a metadata cache path is passed, and are used until they
+    are older than `ttl` or dropped after the server rejected a
+    request made with them.
+    """
+    _entries = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _get_diskcache(path, ttl):
+        # All URLs share one file, so it can be read before we know
+        # which URL and version we end up with
+        diskcache = _BugzillaMetadataCache(path, "connect", ttl)
+        diskcache.load(None)
+        return diskcache
+
+    @classmethod
+    def get(cls, name, url, ttl, path=None):
+        """
+        Return the value stored for `name` of `url`, or None if
+        it is missing or older than ttl
+        """
+        key = "%s %s" % (name, url)
+        with cls._lock:
+            entry = cls._entries.get(key)
+        if entry and time.time() - entry[0] <= ttl:
+            return entry[1]
+
+        if not path:
+            return None
+        diskcache = cls._get_diskcache(path, ttl)
+        value = diskcache.get(key)
+        if value is not None:
+            with cls._lock:
+                cls._entries[key] = (diskcache.get_time(key), value)
+        return value
+
+    @classmethod
+    def set(cls, name, url, value, path=None):
+        key = "%s %s" % (name, url)
+        with cls._lock:
+            cls._entries[key] = (time.time(), value)
+        if path:
+            cls._get_diskcache(path, 0).set(key, value)
+
+    @classmethod
+    def delete(cls, name, url, path=None):
+        key = "%s %s" % (name, url)
+        with cls._lock:
+            cls._entries.pop(key, None)
+        if path:
+            cls._get_diskcache(path, 0).delete(key)
+
+    @classmethod
+    def clear(cls, path=None):
+        with cls._lock:
+            cls._entries.clear()
+        if path:
+            cls._get_diskcache(path, 0).clear()
@@ -14,6 +14,8 @@
 # See the COPYING file in the top-level directory.
 
 import argparse
+import collections
+import concurrent.futures
 import datetime
 import getpass
 import json
@@ -21,8 +23,13 @@ import logging
 import os
 import re
 import shlex
+import signal
 import socket
+import socketserver
+import stat
 import sys
+import threading
+import time
 import types
 import urllib.parse
 import xmlrpc.client
@@ -40,12 +47,18 @@ from ._cli import _setup_action_modify_parser
 from ._cli import _setup_action_attach_parser
 from ._cli import _setup_action_login_parser
 from ._cli import _do_get
-from ._cli import _do_query
+from ._cli import _build_query
 from ._cli import _do_modify
 from ._cli import _do_new
 from ._cli import _convert_to_outputformat
 from ._cli import _xmlrpc_converter
 from ._cli import _bug_field_repl_cb
+from .bug import Bug
+from .exceptions import BugzillaCircuitOpenError
+from ._diskcache import _BugzillaConnectCache
+from ._diskcache import _BugzillaMetadataCache
+from ._mirror import _BugzillaMirror
+from ._session import _RateLimiter
 
 
 DEFAULT_BZ = 'https://bugzilla.redhat.com'
@@ -82,12 +95,56 @@ FLAG_TAIL_ARGINF = "{}ARGINF{}".format(FTAIL_PRE,FTAIL_SUF)
 FLAG_HEAD_ILOGIN = "{}ILOGIN{}".format(FHEAD_PRE,FHEAD_SUF)
 FLAG_TAIL_ILOGIN = "{}ILOGIN{}".format(FTAIL_PRE,FTAIL_SUF)
 
-swrite = sys.stdout.write
-sflush = sys.stdout.flush
-sreadl = sys.stdin.readline
+FLAG_HEAD_FINISH = "{}FINISH{}".format(FHEAD_PRE,FHEAD_SUF)
+FLAG_TAIL_FINISH = "{}FINISH{}".format(FTAIL_PRE,FTAIL_SUF)
 
-__GLOBAL_CACHE_BZI = None
-__GLOBAL_CACHE_ARG = None
+FLAG_HEAD_STREAM = "{}STREAM{}".format(FHEAD_PRE,FHEAD_SUF)
+FLAG_TAIL_STREAM = "{}STREAM{}".format(FTAIL_PRE,FTAIL_SUF)
+
+FLAG_HEAD_TOTALS = "{}TOTALS{}".format(FHEAD_PRE,FHEAD_SUF)
+FLAG_TAIL_TOTALS = "{}TOTALS{}".format(FTAIL_PRE,FTAIL_SUF)
+
+FLAG_HEADS = dict((FLAG, FLAG[len(FHEAD_PRE):-len(FHEAD_SUF)]) for FLAG in (
+    FLAG_HEAD_EXCEPT, FLAG_HEAD_STRING, FLAG_HEAD_FORMAT,
+    FLAG_HEAD_ATTACH, FLAG_HEAD_ARGINF, FLAG_HEAD_ILOGIN,
+    FLAG_HEAD_FINISH, FLAG_HEAD_STREAM, FLAG_HEAD_TOTALS))
+FLAG_TAILS = dict((FLAG, FLAG[len(FTAIL_PRE):-len(FTAIL_SUF)]) for FLAG in (
+    FLAG_TAIL_EXCEPT, FLAG_TAIL_STRING, FLAG_TAIL_FORMAT,
+    FLAG_TAIL_ATTACH, FLAG_TAIL_ARGINF, FLAG_TAIL_ILOGIN,
+    FLAG_TAIL_FINISH, FLAG_TAIL_STREAM, FLAG_TAIL_TOTALS))
+
+# Header of a length-prefixed frame, e.g. "|#>STRING 1234<#|\n"
+FLEN_PRE = "|#>"
+FLEN_SUF = "<#|"
+
+FRAMING_SENTINEL = "sentinel"
+FRAMING_LENGTH   = "length"
+
+INSTR_REFRESH = "__REFRESH__"
+INSTR_TAGGED  = "__TAGGED__"
+INSTR_POOLSTAT = "__POOLSTAT__"
+INSTR_FRAMING = "__FRAMING__"
+INSTR_JSONL = "__JSONL__"
+INSTR_RATELIMIT = "__RATELIMIT__"
+
+DEFAULT_MI_WORKERS = 4
+
+DEFAULT_STREAM_PAGE = 500
+
+DEFAULT_POOL_SIZE = int(os.getenv("PYTHONBUGZILLA_MI_POOL_SIZE") or 8)
+DEFAULT_POOL_IDLE = float(os.getenv("PYTHONBUGZILLA_MI_POOL_IDLE") or 1800)
+
+# "1" for the default location, or the directory to use
+DEFAULT_METADATA_CACHE = os.getenv("PYTHONBUGZILLA_MI_METADATA_CACHE") or None
+if DEFAULT_METADATA_CACHE == "1":
+    DEFAULT_METADATA_CACHE = -1
+DEFAULT_METADATA_TTL = float(os.getenv("PYTHONBUGZILLA_MI_METADATA_TTL") or 86400)
+
+DEFAULT_BUG_CACHE = int(os.getenv("PYTHONBUGZILLA_MI_BUG_CACHE") or 0)
+
+token_re = re.compile(r"^[A-Za-z0-9_.:+-]{1,64}$")
+
+__LOCAL = threading.local()
 
 HANDLE_LOGIN_Y = 0
 HANDLE_LOGIN_N = 1
@@ -95,6 +152,176 @@ HANDLE_LOGIN_N = 1
 class InterruptLoop(Exception): pass
 
 
+###################
+# Output channels #
+###################
+
+class _MISession(object):
+    """ Streams of one MI conversation
+
+    All rounds talking over the same pair of streams share
+    one session. Writing is serialized by `lock` so frames
+    from commands running at the same time never interleave.
+    """
+    def __init__(self, fin, fout):
+        self.fin = fin
+        self.fout = fout
+        self.lock = threading.Lock()
+        self.workers = None
+        self.framing = FRAMING_SENTINEL
+        self.encoding = getattr(fout, "encoding", None) or "utf-8"
+
+    def emit(self, text):
+        with self.lock:
+            self.fout.write(text)
+            self.fout.flush()
+
+    def readline(self):
+        return self.fin.readline()
+
+    def getpass(self):
+        return getpass.getpass()
+
+    def start_workers(self, num):
+        if self.workers is None:
+            self.workers = concurrent.futures.ThreadPoolExecutor(
+                max_workers=num, thread_name_prefix="bzmi")
+        return self.workers
+
+    def close(self):
+        if self.workers is not None:
+            self.workers.shutdown(wait=True)
+            self.workers = None
+
+
+class _MIChannel(object):
+    """ Output of one round in a session
+
+    Text is buffered until `flush` and then handed to the
+    session at once. If `token` is given, every flag-line is
+    tagged with it, e.g. `|v>STRING<v|TOKEN`, so the client
+    could match frames with the command producing them.
+
+    With length framing, flag-lines are not written at all.
+    Each frame is sent as a header line stating its type and
+    the exact size in bytes of the message following it, e.g.
+    `|#>STRING 1234<#|TOKEN`.
+    """
+    def __init__(self, session, token=None):
+        self.session = session
+        self.token = token
+        self._buf = []
+        self._kind = None
+        self._body = []
+        self._stray = False
+
+    def write(self, s):
+        if self.session.framing == FRAMING_LENGTH:
+            self._write_length(s)
+            return
+        if self.token is not None and (s in FLAG_HEADS or s in FLAG_TAILS):
+            s = "%s%s\n" % (s[:-1], self.token)
+        self._buf.append(s)
+
+    def _write_length(self, s):
+        if s in FLAG_HEADS:
+            self._close_frame()
+            self._kind = FLAG_HEADS[s]
+        elif s in FLAG_TAILS:
+            self._close_frame()
+        else:
+            if self._kind is None:
+                # Text outside of any frame is sent as STRING
+                self._kind = "STRING"
+                self._stray = True
+            self._body.append(s)
+
+    def _close_frame(self):
+        if self._kind is None:
+            return
+        payload = "".join(self._body)
+        size = len(payload.encode(self.session.encoding))
+        self._buf.append("%s%s %d%s%s\n" % (FLEN_PRE, self._kind, size,
+                                            FLEN_SUF, self.token or ""))
+        self._buf.append(payload)
+        self._kind = None
+        self._body = []
+        self._stray = False
+
+    def flush(self):
+        if self._stray:
+            self._close_frame()
+        if self._buf:
+            text = "".join(self._buf)
+            self._buf = []
+            self.session.emit(text)
+
+    def readline(self):
+        if self.token is not None:
+            raise bugzilla.BugzillaError("Interactive input is "
+                "not available for tagged commands")
+        self.flush()
+        return self.session.readline()
+
+    def getpass(self):
+        if self.token is not None:
+            raise bugzilla.BugzillaError("Interactive input is "
+                "not available for tagged commands")
+        self.flush()
+        return self.session.getpass()
+
+
+class _MISocketSession(_MISession):
+    """ Session of a client connected to the MI daemon
+
+    There is no terminal to ask for a password,
+    so it is read from the socket like anything else.
+    """
+    def __init__(self, sock):
+        _MISession.__init__(self,
+            sock.makefile("r", encoding="utf-8", newline="\n"),
+            sock.makefile("w", encoding="utf-8", newline="\n"))
+
+    def getpass(self):
+        return self.readline().rstrip("\n")
+
+    def close(self):
+        _MISession.close(self)
+        for f in (self.fin, self.fout):
+            try:
+                f.close()
+            except (OSError, ValueError):
+                pass
+
+
+def _set_channel(channel):
+    __LOCAL.channel = channel
+
+
+def _get_channel():
+    channel = getattr(__LOCAL, "channel", None)
+    if channel is None:
+        channel = _MIChannel(_MISession(sys.stdin, sys.stdout))
+        _set_channel(channel)
+    return channel
+
+
+def swrite(s):
+    _get_channel().write(s)
+
+
+def sflush():
+    _get_channel().flush()
+
+
+def sreadl():
+    return _get_channel().readline()
+
+
+def sgetpw():
+    return _get_channel().getpass()
+
+
 ################
 # Patch output #
 ################
@@ -189,7 +416,7 @@ class Bugzilla_patched(bugzilla.Bugzilla):
             swrite('Bugzilla Password: ')
             swrite(FLAG_TAIL_ILOGIN)
             sflush()
-            password = getpass.getpass()
+            password = sgetpw()
 
         log.info('Logging in... ')
         out = self.login(user, password, restrict_login)
@@ -260,21 +487,84 @@ def setup_parser():
     subparsers.required = True
     _setup_action_new_parser(subparsers)
     _setup_action_get_parser(subparsers)
+    _setup_mi_get_options(subparsers.choices["get"])
     _setup_action_query_parser(subparsers)
+    _setup_mi_query_options(subparsers.choices["query"])
     _setup_action_info_parser(subparsers)
+    _setup_mi_info_options(subparsers.choices["info"])
     _setup_action_modify_parser(subparsers)
     _setup_action_attach_parser(subparsers)
     _setup_action_login_parser(subparsers)
     return rootparser
 
 
+def _setup_mi_query_options(p):
+    g = p.add_argument_group("MI specific options")
+    g.add_argument('--stream', action='store_true', default=False,
+        help="Fetch the results page by page, writing each page in "
+             "its own STREAM frame as soon as it arrives, and a "
+             "TOTALS frame at the end. Pages have --page-size bugs "
+             "(default: %d)." % DEFAULT_STREAM_PAGE)
+    g.add_argument('--mirror', metavar="PATH",
+        help="Answer from the local SQLite mirror at PATH, offline. "
+             "Only --id, --product, --component, --status and "
+             "--assigned_to are supported.")
+    g.add_argument('--sync', action='store_true', default=False,
+        help="With --mirror, run the query on the server and store the "
+             "bugs changed since the last sync of the same query "
+             "(and their comments, with --with-comment) in the mirror.")
+
+
+def _setup_mi_get_options(p):
+    g = p.add_argument_group("MI specific options")
+    g.add_argument('--mirror', metavar="PATH",
+        help="Read the bugs from the local SQLite mirror at PATH, "
+             "offline. See 'query --mirror --sync'.")
+
+
+def _setup_mi_info_options(p):
+    g = p.add_argument_group("MI specific options")
+    g.add_argument('--refresh', action='store_true', default=False,
+        help="Fetch the product data from the server, even if it "
+             "is already cached and not expired.")
+
+
 ####################
 # Command routines #
 ####################
 
+def _info_is_cached(bz, productname, include_fields):
+    """ Whether the API cache of `bz` already holds every field
+    `info` needs, refreshed no longer than the TTL ago
+    """
+    cache = bz._cache
+    now = time.time()
+    if not productname:
+        refreshed = cache.products_all_refreshed
+        products = cache.products
+    else:
+        refreshed = cache.products_refreshed.get(productname)
+        products = [p for p in cache.products
+                    if p.get("name") == productname]
+    if not refreshed or not products:
+        return False
+    if now - refreshed > DEFAULT_METADATA_TTL:
+        return False
+
+    for proddict in products:
+        for field in include_fields:
+            top, _, sub = field.partition(".")
+            if top not in proddict:
+                return False
+            if sub and [c for c in proddict[top] if sub not in c]:
+                return False
+    return True
+
+
 def _do_info(bz, opt):
     """ (Patched version)
-    Handle the 'info' subcommand
+    Handle the 'info' subcommand, but only ask the server
+    if the cache can't answer
     """
     # All these commands call getproducts internally, so do it up front
     # with minimal include_fields for speed
@@ -299,8 +589,11 @@ def _do_info(bz, opt):
     if opt.versions:
         include_fields += ["versions"]
 
-    bz.refresh_products(names=productname and [productname] or None,
-            include_fields=include_fields)
+    if opt.refresh or not _info_is_cached(bz, productname, include_fields):
+        bz.refresh_products(names=productname and [productname] or None,
+                include_fields=include_fields)
+    else:
+        log.debug("Serving info from cache")
 
     swrite(FLAG_HEAD_STRING)
     if opt.products:
@@ -317,7 +610,8 @@ def _do_info(bz, opt):
             swrite("%s\n" % name)
 
     elif opt.versions:
-        proddict = bz.getproducts()[0]
+        # The cache of a warm instance may hold other products too
+        proddict = bz._lookup_product_in_cache(productname)
         for v in proddict['versions']:
             swrite("%s\n" % str(v["name"] or ''))
 
@@ -331,7 +625,7 @@ def _do_info(bz, opt):
 
 def _format_output_json(buglist):
     """ (Patched version) """
-    out = {"bugs": [b.get_raw_data() for b in buglist]}
+    out = {"bugs": [b.get_raw_data_view() for b in buglist]}
     s = json.dumps(out, default=_xmlrpc_converter, indent=None, sort_keys=True)
     swrite(FLAG_HEAD_STRING)
     swrite(s)
@@ -342,42 +636,101 @@ def _format_output_json(buglist):
 def _format_output_raw(buglist):
     """ (Patched version) """
     swrite(FLAG_HEAD_STRING)
+    _write_raw(buglist)
+    swrite(FLAG_TAIL_STRING)
+    sflush()
+
+
+def _write_raw(buglist):
     for b in buglist:
         swrite("Bugzilla %s: \n" % b.bug_id)
         SKIP_NAMES = ["bugzilla"]
-        for attrname in sorted(b.__dict__):
+        attrs = b._get_attributes()
+        for attrname in sorted(attrs):
             if attrname in SKIP_NAMES:
                 continue
             if attrname.startswith("_"):
                 continue
-            swrite("ATTRIBUTE[%s]: %s\n" % (attrname, b.__dict__[attrname]))
+            swrite("ATTRIBUTE[%s]: %s\n" % (attrname, attrs[attrname]))
         swrite("\n*-*-*-*-*\n")
-    swrite(FLAG_TAIL_STRING)
-    sflush()
 
 
-def _format_output(bz, opt, buglist):
-    """ (Patched version) """
+def _output_fields(bz, opt):
+    """ include/exclude/extra fields of raw/json output,
+    processed the same way as `Bugzilla.getbugs` does
+    """
+    extra_fields = list(opt.extrafield or []) + bz._getbug_extra_fields()
+    return bz._process_include_fields(
+        list(opt.includefield or []) or None,
+        list(opt.excludefield or []) or None,
+        extra_fields or None)
+
+
+def _build_output_query(bz, opt, parser):
+    """ Build the query of 'query' like `_do_query`, but for raw/json
+    output ask the search itself for the output fields, rather than
+    only IDs followed by a `getbugs` of all of them
+    """
+    query = _build_query(bz, opt, parser)
     if opt.output in ['raw', 'json']:
-        include_fields = None
-        exclude_fields = None
-        extra_fields = None
+        for key in ["include_fields", "exclude_fields", "extra_fields"]:
+            query.pop(key, None)
+        query.update(_output_fields(bz, opt))
+    return query
 
-        if opt.includefield:
-            include_fields = opt.includefield
-        if opt.excludefield:
-            exclude_fields = opt.excludefield
-        if opt.extrafield:
-            extra_fields = opt.extrafield
 
-        buglist = bz.getbugs([b.bug_id for b in buglist],
-                include_fields=include_fields,
-                exclude_fields=exclude_fields,
-                extra_fields=extra_fields)
+def _refetch_missing(bz, opt, buglist):
+    """ Return `buglist` with every bug lacking a requested
+    output field replaced by one fetched with `getbugs`
+    """
+    fields = _output_fields(bz, opt)
+    include_fields = fields.get("include_fields") or []
+    exclude_fields = fields.get("exclude_fields") or []
+    wanted = set(f.split(".")[0] for f in include_fields)
+    if not include_fields or "_default" in wanted:
+        wanted.update(fields.get("extra_fields") or [])
+    wanted.difference_update(exclude_fields)
+    wanted.discard("_default")
+
+    if any(f.startswith("_") for f in wanted):
+        # _all, _extra, ... can't be checked, so always refetch
+        missing = [b.bug_id for b in buglist]
+    else:
+        missing = [b.bug_id for b in buglist
+                   if not wanted.issubset(b._rawdata)]
+    if not missing:
+        return buglist
+    log.debug("Search lacks requested fields for %d bugs, refetching",
+              len(missing))
+
+    fetched = bz.getbugs(missing,
+            include_fields=opt.includefield,
+            exclude_fields=opt.excludefield,
+            extra_fields=opt.extrafield)
+    fetched = dict((b.bug_id, b) for b in fetched if b)
+    return [fetched.get(b.bug_id, b) for b in buglist]
+
+
+def _format_output(bz, opt, buglist, prefetched=False, offline=False):
+    """ (Patched version)
+    With `prefetched`, `buglist` already came with the output
+    fields, and only bugs missing some of them are refetched.
+    With `offline`, `buglist` came from a mirror together with
+    comments if needed, and nothing is fetched at all.
+    """
+    if opt.output in ['raw', 'json']:
+        if offline:
+            pass
+        elif prefetched:
+            buglist = _refetch_missing(bz, opt, buglist)
+        else:
+            buglist = bz.getbugs([b.bug_id for b in buglist],
+                    include_fields=opt.includefield,
+                    exclude_fields=opt.excludefield,
+                    extra_fields=opt.extrafield)
 
-        if opt.with_comment:
-            for b in buglist:
-                b.getcomments_attr()
+        if opt.with_comment and not offline:
+            bz.get_comments_attr(buglist)
 
         if opt.output == 'json':
             _format_output_json(buglist)
@@ -386,9 +739,9 @@ def _format_output(bz, opt, buglist):
         return
 
     swrite(FLAG_HEAD_FORMAT)
+    if opt.with_comment and not offline:
+        bz.get_comments_attr(buglist)
     for b in buglist:
-        if opt.with_comment:
-            b.getcomments_attr()
         # pylint: disable=cell-var-from-loop
         def cb(matchobj):
             return _bug_field_repl_cb(bz, b, matchobj)
@@ -398,6 +751,152 @@ def _format_output(bz, opt, buglist):
     sflush()
 
 
+def _get_page_size(opt, parser):
+    if opt.page_size is None:
+        return DEFAULT_STREAM_PAGE
+    if opt.page_size < 1:
+        parser.error("--page-size must be a positive number")
+    return opt.page_size
+
+
+def _do_query_stream(bz, opt, parser):
+    """ Handle 'query --stream'
+
+    Each page is written and flushed in its own STREAM frame, in
+    the same output format as without --stream except that JSON
+    is one bug object per line. A TOTALS frame closes the stream.
+    """
+    if opt.split_by:
+        parser.error("--split-by and --stream can't be combined")
+    start = time.monotonic()
+    query = _build_output_query(bz, opt, parser)
+    nbugs = 0
+    npages = 0
+    for buglist in bz._query_pages(query, _get_page_size(opt, parser),
+                                   readahead=True):
+        if opt.output in ['raw', 'json']:
+            buglist = _refetch_missing(bz, opt, buglist)
+        if opt.with_comment:
+            bz.get_comments_attr(buglist)
+        swrite(FLAG_HEAD_STREAM)
+        for b in buglist:
+            if opt.output == 'json':
+                swrite(json.dumps(b.get_raw_data_view(),
+                                  default=_xmlrpc_converter,
+                                  indent=None, sort_keys=True))
+                swrite("\n")
+            elif opt.output != 'raw':
+                # pylint: disable=cell-var-from-loop
+                def cb(matchobj):
+                    return _bug_field_repl_cb(bz, b, matchobj)
+                swrite(format_field_re.sub(cb, opt.outputformat))
+                swrite("\n")
+        if opt.output == 'raw':
+            _write_raw(buglist)
+        swrite(FLAG_TAIL_STREAM)
+        sflush()
+        nbugs += len(buglist)
+        npages += 1
+
+    swrite(FLAG_HEAD_TOTALS)
+    swrite(json.dumps({"bugs": nbugs, "pages": npages,
+                       "elapsed": round(time.monotonic() - start, 3)},
+                      sort_keys=True))
+    swrite(FLAG_TAIL_TOTALS)
+    sflush()
+
+
+__MIRRORS = {}
+__MIRRORS_LOCK = threading.Lock()
+
+
+def _get_mirror(path):
+    """ Open the mirror at `path` once, and share it """
+    path = os.path.abspath(os.path.expanduser(path))
+    with __MIRRORS_LOCK:
+        if path not in __MIRRORS:
+            __MIRRORS[path] = _BugzillaMirror(path)
+        return __MIRRORS[path]
+
+
+def _is_offline(opt):
+    return bool(getattr(opt, "mirror", None) and
+                not getattr(opt, "sync", False))
+
+
+def _mirror_bugs(bz, opt, bugdicts):
+    """ Turn raw bug dicts from a mirror into `Bug` objects,
+    applying --includefield and --excludefield locally
+    """
+    buglist = []
+    for bugdict in bugdicts:
+        if opt.includefield:
+            bugdict = dict((k, v) for k, v in bugdict.items()
+                           if k in opt.includefield or k == "id")
+        for k in opt.excludefield or []:
+            bugdict.pop(k, None)
+        buglist.append(Bug(bz, dict=bugdict))
+    return buglist
+
+
+def _do_get_mirror(bz, opt, parser):
+    mirror = _get_mirror(opt.mirror)
+    bz.url = mirror.get_url() or ""
+    if opt.alias:
+        parser.error("--alias is not supported with --mirror")
+    idlist = opt.id_lst and opt.id_lst.split(",") or opt.id
+    idlist = [str(i).strip() for i in idlist]
+    badids = [i for i in idlist if not i.isdigit()]
+    if badids:
+        parser.error("Bug IDs must be numeric with --mirror: %s" %
+                     ",".join(badids))
+
+    bugdicts = mirror.get(idlist, with_comments=opt.with_comment)
+    missing = [i for i, b in zip(idlist, bugdicts) if not b]
+    if missing:
+        raise bugzilla.BugzillaError("Bugs not in the mirror: %s" %
+                                     ",".join(missing))
+    return _mirror_bugs(bz, opt, bugdicts)
+
+
+def _do_query_mirror(bz, opt, parser):
+    mirror = _get_mirror(opt.mirror)
+    bz.url = mirror.get_url() or ""
+    query = _build_query(bz, opt, parser)
+    for key in ["include_fields", "exclude_fields", "extra_fields"]:
+        query.pop(key, None)
+
+    kwargs = {}
+    for key, arg in [("id", "ids"), ("product", "product"),
+                     ("component", "component"), ("bug_status", "status"),
+                     ("assigned_to", "assigned_to")]:
+        if key in query:
+            kwargs[arg] = query.pop(key)
+    if query:
+        parser.error("Not supported with --mirror: %s" %
+                     ", ".join(sorted(query)))
+    if "ids" in kwargs:
+        kwargs["ids"] = [int(i) for i in kwargs["ids"]]
+
+    bugdicts = mirror.query(with_comments=opt.with_comment, **kwargs)
+    return _mirror_bugs(bz, opt, bugdicts)
+
+
+def _do_sync_mirror(bz, opt, parser):
+    mirror = _get_mirror(opt.mirror)
+    query = _build_query(bz, opt, parser)
+    # Mirror everything the search returns by default
+    for key in ["include_fields", "exclude_fields"]:
+        query.pop(key, None)
+
+    ret = mirror.sync(bz, query, with_comments=opt.with_comment,
+                      page_size=_get_page_size(opt, parser))
+    swrite(FLAG_HEAD_STRING)
+    swrite(json.dumps(ret, sort_keys=True))
+    swrite(FLAG_TAIL_STRING)
+    sflush()
+
+
 def _do_get_attach(bz, opt):
     """ (Patched version)
     Replace original print statement;
@@ -480,37 +979,159 @@ def _do_set_attach(bz, opt, parser):
 # Main handling #
 #################
 
-def _make_bz_instance(opt, force_new=False):
-    """ (Patched version)
-    Build a new Bugzilla instance we will use
-    if necessary. Otherwise return the old one.
+class _BugzillaPool(object):
+    """ Bounded pool of warm `Bugzilla` instances
+
+    Instances are keyed by the arguments creating them. When
+    the pool is full the least recently used one is evicted,
+    and any instance idle for longer than `maxidle` seconds
+    expires. Creating an instance never blocks lookups of
+    other keys, but concurrent lookups of the same key wait
+    for one creation instead of racing.
     """
-    global __GLOBAL_CACHE_BZI
-    global __GLOBAL_CACHE_ARG
-    
-    if opt.bztype != 'auto':
-        log.info("Explicit --bztype is no longer supported, ignoring")
+    def __init__(self, maxsize, maxidle):
+        self.maxsize = max(1, maxsize)
+        self.maxidle = maxidle
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        # key -> [lock, number of get() calls using it]
+        self._keylocks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _make_key(args):
+        return tuple(sorted(args.items()))
+
+    def _drop_keylock(self, key):
+        # Called with self._lock held, once the key has no entry
+        # or once its last get() is done
+        keylock = self._keylocks.get(key)
+        if keylock and not keylock[1] and key not in self._entries:
+            del self._keylocks[key]
+
+    def _drop(self, key):
+        # Called with self._lock held
+        del self._entries[key]
+        self._drop_keylock(key)
+
+    def _expire(self, now):
+        for key, entry in list(self._entries.items()):
+            if now - entry["used"] > self.maxidle:
+                self._drop(key)
+                self.expirations += 1
+                log.debug("Pool expired instance for %s", entry["args"]["url"])
+
+    def get(self, args, force_new=False):
+        key = self._make_key(args)
+        with self._lock:
+            self._expire(time.monotonic())
+            keylock = self._keylocks.setdefault(key, [threading.Lock(), 0])
+            keylock[1] += 1
 
+        try:
+            return self._get(key, keylock[0], args, force_new)
+        finally:
+            with self._lock:
+                keylock[1] -= 1
+                self._drop_keylock(key)
+
+    def _get(self, key, keylock, args, force_new):
+        with keylock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and not force_new:
+                    self.hits += 1
+                    entry["used"] = time.monotonic()
+                    entry["uses"] += 1
+                    self._entries.move_to_end(key)
+                    return entry["bzi"]
+                self.misses += 1
+
+            bzi = Bugzilla_patched(**args)
+            with self._lock:
+                self._entries[key] = {"bzi": bzi, "args": args, "uses": 1,
+                                      "used": time.monotonic()}
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    oldkey, oldentry = next(iter(self._entries.items()))
+                    self._drop(oldkey)
+                    self.evictions += 1
+                    log.debug("Pool evicted instance for %s",
+                              oldentry["args"]["url"])
+            return bzi
+
+    def discard(self, bzi):
+        """ Drop `bzi` so its key gets a new instance next time """
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry["bzi"] is bzi:
+                    self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._drop(key)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "maxidle": self.maxidle,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "instances": [{
+                    "url": entry["bzi"].url,
+                    "sslverify": entry["args"]["sslverify"],
+                    "use_creds": entry["args"]["use_creds"],
+                    "uses": entry["uses"],
+                    "idle": round(now - entry["used"], 3),
+                } for entry in reversed(self._entries.values())],
+            }
+
+
+__GLOBAL_POOL = _BugzillaPool(DEFAULT_POOL_SIZE, DEFAULT_POOL_IDLE)
+
+
+def _make_bz_args(url, sslverify=True, cert=None, cache_credentials=True,
+                  cookiefile=None, tokenfile=None):
+    """ Arguments of `Bugzilla_patched`, also the key in the pool """
     new_ARG = {
-        "url"        : opt.bugzilla,
+        "url"        : url,
         "cookiefile" : None,
         "tokenfile"  : None,
-        "sslverify"  : opt.sslverify,
+        "sslverify"  : sslverify,
         "use_creds"  : False,
-        "cert"       : opt.cert
+        "cert"       : cert,
+        "metadatacache"     : DEFAULT_METADATA_CACHE,
+        "metadatacache_ttl" : DEFAULT_METADATA_TTL,
+        "bugcache"          : DEFAULT_BUG_CACHE
     }
-    if opt.cache_credentials:
-        new_ARG["cookiefile"] = opt.cookiefile or -1
-        new_ARG["tokenfile" ] = opt.tokenfile  or -1
+    if cache_credentials:
+        new_ARG["cookiefile"] = cookiefile or -1
+        new_ARG["tokenfile" ] = tokenfile  or -1
         new_ARG["use_creds" ] = True
+    return new_ARG
 
-    if (force_new is True) or (new_ARG != __GLOBAL_CACHE_ARG):
-        new_BZI = Bugzilla_patched(**new_ARG)
-        __GLOBAL_CACHE_ARG = new_ARG
-        __GLOBAL_CACHE_BZI = new_BZI
-        return new_BZI
-    else:
-        return __GLOBAL_CACHE_BZI
+
+def _make_bz_instance(opt, force_new=False):
+    """ (Patched version)
+    Get a warm Bugzilla instance from the pool,
+    and build a new one only if necessary.
+    """
+    if opt.bztype != 'auto':
+        log.info("Explicit --bztype is no longer supported, ignoring")
+
+    new_ARG = _make_bz_args(opt.bugzilla, opt.sslverify, opt.cert,
+                            opt.cache_credentials,
+                            opt.cookiefile, opt.tokenfile)
+    return __GLOBAL_POOL.get(new_ARG, force_new=force_new)
 
 
 def _handle_login(opt, action, bz):
@@ -553,130 +1174,608 @@ def _handle_login(opt, action, bz):
         raise InterruptLoop(HANDLE_LOGIN_Y)
 
 
-def _main(unittest_bz_instance):
-    """ (Patched version)
+def _run_round(parser, NewCmd, unittest_bz_instance):
+    """ Run one round of MI with the command line `NewCmd`
+
+    Everything is written to the channel of current thread.
     """
-    # init argparser & logger
-    setup_logging()
-    parser = setup_parser()
-    bz_REFRESH = False
+    try:
+        NewOpt = parser.parse_args(args = shlex.split(NewCmd))
+    except InterruptLoop:
+        return
+    level_logging(NewOpt.debug, NewOpt.verbose)
+    log.debug("Launched with command line: %s", NewCmd)
+    log.debug("Bugzilla module: %s", bugzilla)
+    NewAct = NewOpt.command
+
+    try:
+        if unittest_bz_instance:
+            bz = unittest_bz_instance
+        elif _is_offline(NewOpt):
+            bz = Bugzilla_patched(url=None, use_creds=False)
+        else:
+            bz = _make_bz_instance(NewOpt)
+    except Exception as E:
+        swrite(FLAG_HEAD_EXCEPT)
+        swrite("CANNOT create the instance of `bugzilla.Bugzilla` ")
+        swrite("with args ` %s ` because of " % NewCmd)
+        swrite("%s: %s" %(E.__class__.__name__,str(E)))
+        swrite(FLAG_TAIL_EXCEPT)
+        sflush()
+        return
+
+    try:
+        # Handle login options
+        _handle_login(NewOpt, NewAct, bz)
+    except InterruptLoop:
+        return
+    except Exception as E:
+        # not BaseException to jump KeyboardInterrupt
+        swrite(FLAG_HEAD_EXCEPT)
+        swrite("Hit %s:\n%s" %(E.__class__.__name__,str(E)))
+        swrite(FLAG_TAIL_EXCEPT)
+        sflush()
+        return
+
+    if hasattr(NewOpt, "outputformat"):
+        if not NewOpt.outputformat and NewOpt.output not in ['raw', 'json', None]:
+            NewOpt.outputformat = _convert_to_outputformat(NewOpt.output)
+    buglist = []
+    try:
+        if NewAct == 'info':
+            _do_info(bz, NewOpt)
+
+        elif NewAct == 'get' and _is_offline(NewOpt):
+            buglist = _do_get_mirror(bz, NewOpt, parser)
+
+        elif NewAct == 'get':
+            buglist = _do_get(bz, NewOpt)
+
+        elif NewAct == 'query' and NewOpt.mirror and NewOpt.sync:
+            _do_sync_mirror(bz, NewOpt, parser)
+            return
+
+        elif NewAct == 'query' and NewOpt.mirror:
+            buglist = _do_query_mirror(bz, NewOpt, parser)
+
+        elif NewAct == 'query' and NewOpt.stream:
+            _do_query_stream(bz, NewOpt, parser)
+            return
+
+        elif NewAct == 'query' and NewOpt.split_by:
+            if NewOpt.page_size is not None:
+                parser.error("--split-by and --page-size can't be combined")
+            buglist = bz.query_split(_build_output_query(bz, NewOpt, parser),
+                                     split_by=NewOpt.split_by)
+
+        elif NewAct == 'query' and NewOpt.page_size is not None:
+            buglist = list(bz.query_iter(
+                _build_output_query(bz, NewOpt, parser),
+                page_size=_get_page_size(NewOpt, parser), readahead=True))
+
+        elif NewAct == 'query':
+            buglist = bz.query(_build_output_query(bz, NewOpt, parser))
+
+        elif NewAct == 'new':
+            buglist = _do_new(bz, NewOpt, parser)
+
+        elif NewAct == 'attach':
+            if NewOpt.get or NewOpt.getall:
+                if NewOpt.ids:
+                    parser.error("Bug IDs '%s' not used for "
+                        "getting attachments" % NewOpt.ids)
+                _do_get_attach(bz, NewOpt)
+            else:
+                _do_set_attach(bz, NewOpt, parser)
+
+        elif NewAct == 'modify':
+            _do_modify(bz, parser, NewOpt)
+        else:
+            return
+
+        # If we're doing new/query/modify, output our results
+        if NewAct in ['new', 'query', 'get']:
+            _format_output(bz, NewOpt, buglist,
+                           prefetched=(NewAct == 'query'),
+                           offline=_is_offline(NewOpt))
+    except InterruptLoop:
+        return
+    except BugzillaCircuitOpenError as e:
+        # The server is down, but the instance is fine. Keep it and its
+        # caches for when the server is back.
+        swrite(FLAG_HEAD_EXCEPT)
+        swrite("Server unavailable - %s: %s" %(e.__class__.__name__,str(e)))
+        swrite(FLAG_TAIL_EXCEPT)
+    except (xmlrpc.client.Fault, bugzilla.BugzillaError) as e:
+        swrite(FLAG_HEAD_EXCEPT)
+        swrite("Server error - %s: %s" %(e.__class__.__name__,str(e)))
+        swrite(FLAG_TAIL_EXCEPT)
+        __GLOBAL_POOL.discard(bz)
+    except requests.exceptions.SSLError as e:
+        # Give SSL recommendations
+        swrite(FLAG_HEAD_EXCEPT)
+        swrite("SSL error: %s" % e)
+        swrite("\nIf you trust the remote server, you can work "
+               "around this error with `--nosslverify`")
+        swrite(FLAG_TAIL_EXCEPT)
+        __GLOBAL_POOL.discard(bz)
+    except (socket.error,
+            requests.exceptions.HTTPError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.InvalidURL,
+            xmlrpc.client.ProtocolError) as e:
+        swrite(FLAG_HEAD_EXCEPT)    
+        swrite("Connection lost/failed - %s: %s" %(e.__class__.__name__,str(e)))
+        swrite(FLAG_TAIL_EXCEPT)
+        __GLOBAL_POOL.discard(bz)
+
+
+def _run_tagged_round(session, parser, token, NewCmd, unittest_bz_instance):
+    """ Run one round on a worker of `session`
+
+    Frames are tagged with `token`, and a FINISH frame
+    always closes the round so the client knows that
+    nothing more would come with this token.
+    """
+    _set_channel(_MIChannel(session, token))
+    try:
+        _run_round(parser, NewCmd, unittest_bz_instance)
+    except InterruptLoop:
+        pass
+    except Exception as E:
+        # Serial rounds would crash MI here, but a worker
+        # has nobody to report to except the client
+        log.debug("", exc_info=True)
+        swrite(FLAG_HEAD_EXCEPT)
+        swrite("Hit %s:\n%s" %(E.__class__.__name__,str(E)))
+        swrite(FLAG_TAIL_EXCEPT)
+    finally:
+        swrite(FLAG_HEAD_FINISH)
+        swrite(token)
+        swrite(FLAG_TAIL_FINISH)
+        sflush()
+
+
+#######################
+# JSON-lines handling #
+#######################
+
+def _jsonl_info(bz, params):
+    what = params.get("what", "products")
+    product = params.get("product")
+    include_fields = ["name", "id"]
+    if what in ("components", "component_owners"):
+        include_fields += ["components.name", "components.is_active",
+                           "components.default_assigned_to"]
+    elif what == "versions":
+        include_fields += ["versions"]
+    elif what != "products":
+        raise ValueError("Unknown info `what`: %s" % what)
+    if what != "products" and not product:
+        raise ValueError("info `%s` requires `product`" % what)
+
+    if (params.get("refresh") or
+            not _info_is_cached(bz, product, include_fields)):
+        bz.refresh_products(names=product and [product] or None,
+                            include_fields=include_fields)
+    else:
+        log.debug("Serving info from cache")
+    if what == "products":
+        return sorted([p["name"] for p in bz.getproducts()])
+    if what == "versions":
+        # The cache of a warm instance may hold other products too
+        proddict = bz._lookup_product_in_cache(product)
+        return [v["name"] for v in proddict["versions"]]
+    details = bz.getcomponentsdetails(product)
+    if what == "components":
+        return sorted(details)
+    return dict((c, details[c].get("default_assigned_to"))
+                for c in sorted(details))
+
+
+def _jsonl_get(bz, params):
+    buglist = bz.getbugs(params["ids"],
+        include_fields=params.get("include_fields"),
+        exclude_fields=params.get("exclude_fields"),
+        extra_fields=params.get("extra_fields"),
+        permissive=params.get("permissive", True))
+    return {"bugs": [b and b.get_raw_data_view() for b in buglist]}
+
+
+def _jsonl_query(bz, params):
+    query = bz.build_query(**params)
+    return {"bugs": [b.get_raw_data_view() for b in bz.query(query)]}
+
+
+def _jsonl_modify(bz, params):
+    updates = bz.build_update(**params.get("updates", {}))
+    return bz.update_bugs(params["ids"], updates)
+
+
+def _jsonl_new(bz, params):
+    bug = bz.createbug(bz.build_createbug(**params))
+    return {"id": bug.bug_id}
+
+
+def _jsonl_attach(bz, params):
+    if params.get("get") or params.get("getall"):
+        return bz.get_attachments(params.get("getall"), params.get("get"),
+            include_fields=params.get("include_fields"),
+            exclude_fields=params.get("exclude_fields"))
+    kwargs = dict((k, params[k]) for k in
+                  ("content_type", "comment", "is_private", "is_patch",
+                   "file_name") if k in params)
+    # attachfile() doesn't close a file it opened itself
+    with open(params["file"], "rb") as fileobj:
+        return {"ids": bz.attachfile(params["ids"], fileobj,
+                                     params.get("description") or
+                                     os.path.basename(params["file"]),
+                                     **kwargs)}
+
+
+_JSONL_ACTIONS = {
+    "info"   : _jsonl_info,
+    "get"    : _jsonl_get,
+    "query"  : _jsonl_query,
+    "modify" : _jsonl_modify,
+    "new"    : _jsonl_new,
+    "attach" : _jsonl_attach,
+}
+
+
+def _run_jsonl_round(session, line, unittest_bz_instance):
+    """ Run one JSON request and emit exactly one JSON response line
+
+    The request maps directly onto `Bugzilla` methods, without
+    going through `shlex` and argparse at all.
+    """
+    start = time.monotonic()
+    out = {"id": None}
+    bz = None
+    try:
+        req = json.loads(line)
+        if not isinstance(req, dict):
+            raise ValueError("Request must be a JSON object")
+        out["id"] = req.get("id")
+        action = _JSONL_ACTIONS.get(req.get("action"))
+        if not action:
+            raise ValueError("Unknown action: %s" % req.get("action"))
+        params = req.get("params") or {}
+
+        if unittest_bz_instance:
+            bz = unittest_bz_instance
+        else:
+            bz = __GLOBAL_POOL.get(_make_bz_args(
+                req.get("bugzilla") or DEFAULT_BZ,
+                req.get("sslverify", True), req.get("cert"),
+                req.get("cache_credentials", True),
+                req.get("cookiefile"), req.get("tokenfile")))
+
+        out["result"] = action(bz, params)
+        out["status"] = "ok"
+    except Exception as E:
+        # not BaseException to jump KeyboardInterrupt
+        log.debug("", exc_info=True)
+        out["status"] = "error"
+        out["error"] = {"type": E.__class__.__name__, "message": str(E)}
+        if bz is not None and isinstance(E, (
+                xmlrpc.client.Fault, bugzilla.BugzillaError, socket.error,
+                requests.exceptions.RequestException,
+                xmlrpc.client.ProtocolError)) and not isinstance(
+                E, BugzillaCircuitOpenError):
+            __GLOBAL_POOL.discard(bz)
+    out["elapsed"] = round(time.monotonic() - start, 6)
+
+    try:
+        text = json.dumps(out, default=_xmlrpc_converter, sort_keys=True)
+    except Exception as E:
+        text = json.dumps({"id": out["id"], "status": "error",
+                           "elapsed": out["elapsed"],
+                           "error": {"type": E.__class__.__name__,
+                                     "message": str(E)}}, default=str)
+    session.emit(text + "\n")
+
+
+def _serve_jsonl(session, unittest_bz_instance):
+    """ Loop of JSON-lines mode, until the input stream reaches EOF
+
+    Requests run on the workers of `session` if there are any,
+    so responses may come back out of order and should be
+    matched by `id`.
+    """
+    while True:
+        line = session.readline()
+        if not line:
+            break
+        line = line.strip()
+        if not line:
+            continue
+        if session.workers:
+            session.workers.submit(_run_jsonl_round, session, line,
+                                   unittest_bz_instance)
+        else:
+            _run_jsonl_round(session, line, unittest_bz_instance)
+
+
+def _serve(session, parser, unittest_bz_instance):
+    """ Loop of reading and running rounds on `session`
+
+    Return when the input stream reaches EOF.
+    """
+    tagged_workers = 0
+    _set_channel(_MIChannel(session))
 
-    # main loop
     while True:
         swrite(FLAG_HEAD_ARGINF)
         swrite("ArgumentParser waiting")
         swrite(FLAG_TAIL_ARGINF)
         sflush()
 
-        try:
-            NewCmd = sreadl().strip()
-            if (NewCmd == "__REFRESH__"):
-                bz_REFRESH = True
+        NewCmd = sreadl()
+        if not NewCmd:
+            break
+        NewCmd = NewCmd.strip()
+
+        if (NewCmd == INSTR_REFRESH):
+            __GLOBAL_POOL.clear()
+            _BugzillaConnectCache.clear(
+                _BugzillaMetadataCache.get_default_path()
+                if DEFAULT_METADATA_CACHE == -1 else DEFAULT_METADATA_CACHE)
+            continue
+
+        if (NewCmd == INSTR_POOLSTAT):
+            swrite(FLAG_HEAD_STRING)
+            swrite(json.dumps(__GLOBAL_POOL.stats(), sort_keys=True))
+            swrite(FLAG_TAIL_STRING)
+            continue
+
+        if (NewCmd.split(None, 1)[:1] == [INSTR_RATELIMIT]):
+            _do_ratelimit(NewCmd.split()[1:])
+            continue
+
+        if (NewCmd.split(None, 1)[:1] == [INSTR_FRAMING]):
+            NewArg = NewCmd.split()[1:]
+            if NewArg not in ([FRAMING_SENTINEL], [FRAMING_LENGTH]):
+                swrite(FLAG_HEAD_ARGINF)
+                swrite("Usage: %s %s|%s" % (INSTR_FRAMING,
+                       FRAMING_SENTINEL, FRAMING_LENGTH))
+                swrite(FLAG_TAIL_ARGINF)
                 continue
-            NewOpt = parser.parse_args(args = shlex.split(NewCmd))
-        except InterruptLoop:
+            sflush()
+            session.framing = NewArg[0]
+            swrite(FLAG_HEAD_ARGINF)
+            swrite("Framing %s" % session.framing)
+            swrite(FLAG_TAIL_ARGINF)
             continue
-        level_logging(NewOpt.debug, NewOpt.verbose)
-        log.debug("Launched with command line: %s", NewCmd)
-        log.debug("Bugzilla module: %s", bugzilla)
-        NewAct = NewOpt.command
 
-        try:
-            if unittest_bz_instance:
-                bz = unittest_bz_instance
-            else:
-                bz = _make_bz_instance(NewOpt, force_new=bz_REFRESH)
-                bz_REFRESH = False
-        except Exception as E:
-            swrite(FLAG_HEAD_EXCEPT)
-            swrite("CANNOT create the instance of `bugzilla.Bugzilla` ")
-            swrite("with args ` %s ` because of " % NewCmd)
-            swrite("%s: %s" %(E.__class__.__name__,str(E)))
-            swrite(FLAG_TAIL_EXCEPT)
+        if (NewCmd.split(None, 1)[:1] == [INSTR_JSONL]):
+            NewArg = NewCmd.split()[1:]
+            if (len(NewArg) > 1) or (NewArg and not NewArg[0].isdigit()) \
+                    or (NewArg and int(NewArg[0]) < 1):
+                swrite(FLAG_HEAD_ARGINF)
+                swrite("Usage: %s [WORKERS]" % INSTR_JSONL)
+                swrite(FLAG_TAIL_ARGINF)
+                continue
+            if NewArg and not tagged_workers:
+                tagged_workers = int(NewArg[0])
+                session.start_workers(tagged_workers)
+            swrite(FLAG_HEAD_ARGINF)
+            swrite("JSON-lines mode with %d workers" % tagged_workers)
+            swrite(FLAG_TAIL_ARGINF)
             sflush()
+            _serve_jsonl(session, unittest_bz_instance)
+            break
+
+        if (NewCmd.split(None, 1)[:1] == [INSTR_TAGGED]):
+            NewArg = NewCmd.split()[1:]
+            if (len(NewArg) > 1) or (NewArg and not NewArg[0].isdigit()) \
+                    or (NewArg and int(NewArg[0]) < 1):
+                swrite(FLAG_HEAD_ARGINF)
+                swrite("Usage: %s [WORKERS]" % INSTR_TAGGED)
+                swrite(FLAG_TAIL_ARGINF)
+                continue
+            if not tagged_workers:
+                tagged_workers = int(NewArg and NewArg[0] or DEFAULT_MI_WORKERS)
+                session.start_workers(tagged_workers)
+            swrite(FLAG_HEAD_ARGINF)
+            swrite("Tagged mode with %d workers" % tagged_workers)
+            swrite(FLAG_TAIL_ARGINF)
             continue
 
-        try:
-            # Handle login options
-            _handle_login(NewOpt, NewAct, bz)
-        except InterruptLoop:
+        if not tagged_workers:
+            _run_round(parser, NewCmd, unittest_bz_instance)
             continue
-        except Exception as E:
-            # not BaseException to jump KeyboardInterrupt
-            swrite(FLAG_HEAD_EXCEPT)
-            swrite("Hit %s:\n%s" %(E.__class__.__name__,str(E)))
-            swrite(FLAG_TAIL_EXCEPT)
-            sflush()
+
+        NewTok, _, NewCmd = NewCmd.partition(" ")
+        if not token_re.match(NewTok):
+            swrite(FLAG_HEAD_ARGINF)
+            swrite("Tagged mode requires `TOKEN ARGS`, where TOKEN "
+                   "matches %s" % token_re.pattern)
+            swrite(FLAG_TAIL_ARGINF)
             continue
+        session.workers.submit(_run_tagged_round, session, parser,
+                               NewTok, NewCmd, unittest_bz_instance)
+
+    session.close()
+
 
-        if hasattr(NewOpt, "outputformat"):
-            if not NewOpt.outputformat and NewOpt.output not in ['raw', 'json', None]:
-                NewOpt.outputformat = _convert_to_outputformat(NewOpt.output)
-        buglist = []
+def _do_ratelimit(NewArg):
+    """ Handle `__RATELIMIT__ [HOST] [RATE [BURST]]`
+
+    Set the requests per second and burst of HOST, or of all hosts,
+    and report the limits and how long requests waited for them.
+    A RATE of 0 means no limit, '-' drops the setting.
+    """
+    def _is_number(val):
         try:
-            if NewAct == 'info':
-                _do_info(bz, NewOpt)
+            float(val)
+            return True
+        except ValueError:
+            return val == "-"
+
+    host = None
+    if NewArg and not _is_number(NewArg[0]):
+        host = NewArg.pop(0)
+    if (len(NewArg) > 2 or (host and not NewArg) or
+            not all(_is_number(a) for a in NewArg) or
+            (len(NewArg) > 1 and not NewArg[1].isdigit())):
+        swrite(FLAG_HEAD_ARGINF)
+        swrite("Usage: %s [HOST] [RATE [BURST]]" % INSTR_RATELIMIT)
+        swrite(FLAG_TAIL_ARGINF)
+        return
 
-            elif NewAct == 'get':
-                buglist = _do_get(bz, NewOpt)
+    if NewArg:
+        rate = None if NewArg[0] == "-" else float(NewArg[0])
+        burst = len(NewArg) > 1 and int(NewArg[1]) or None
+        _RateLimiter.set_limit(rate, burst, host=host)
+    swrite(FLAG_HEAD_STRING)
+    swrite(json.dumps(_RateLimiter.stats(), sort_keys=True))
+    swrite(FLAG_TAIL_STRING)
 
-            elif NewAct == 'query':
-                buglist = _do_query(bz, NewOpt, parser)
 
-            elif NewAct == 'new':
-                buglist = _do_new(bz, NewOpt, parser)
+def _setup_daemon_parser():
+    """ Options of running `bugzilla-mi` itself
 
-            elif NewAct == 'attach':
-                if NewOpt.get or NewOpt.getall:
-                    if NewOpt.ids:
-                        parser.error("Bug IDs '%s' not used for "
-                            "getting attachments" % NewOpt.ids)
-                    _do_get_attach(bz, NewOpt)
-                else:
-                    _do_set_attach(bz, NewOpt, parser)
+    Built before `setup_parser` applies the monkey patch,
+    so wrong options still end the process as usual.
+    """
+    p = argparse.ArgumentParser(prog="bugzilla-mi",
+        description="Serve the MI on stdin/stdout, or as a daemon "
+                    "when any listening address is given.")
+    p.add_argument("--unix-socket", metavar="PATH",
+        help="Listen on a Unix domain socket created at PATH")
+    p.add_argument("--tcp-port", metavar="PORT", type=int,
+        help="Listen on localhost TCP PORT")
+    return p
+
+
+class _MIRequestHandler(socketserver.BaseRequestHandler):
+    """ Serve one client of the MI daemon
+    """
+    def handle(self):
+        session = _MISocketSession(self.request)
+        log.info("MI client connected: %s", self.client_address)
+        try:
+            _serve(session, self.server.mi_parser,
+                   self.server.mi_unittest_bz_instance)
+        except (OSError, ValueError) as e:
+            log.info("MI client gone: %s", e)
+        finally:
+            session.close()
 
-            elif NewAct == 'modify':
-                _do_modify(bz, parser, NewOpt)
-            else:
-                continue
 
-            # If we're doing new/query/modify, output our results
-            if NewAct in ['new', 'query', 'get']:
-                _format_output(bz, NewOpt, buglist)
-        except InterruptLoop:
-            continue
-        except (xmlrpc.client.Fault, bugzilla.BugzillaError) as e:
-            swrite(FLAG_HEAD_EXCEPT)
-            swrite("Server error - %s: %s" %(e.__class__.__name__,str(e)))
-            swrite(FLAG_TAIL_EXCEPT)
-            bz_REFRESH = True
-            continue
-        except requests.exceptions.SSLError as e:
-            # Give SSL recommendations
-            swrite(FLAG_HEAD_EXCEPT)
-            swrite("SSL error: %s" % e)
-            swrite("\nIf you trust the remote server, you can work "
-                   "around this error with `--nosslverify`")
-            swrite(FLAG_TAIL_EXCEPT)
-            bz_REFRESH = True
-            continue
-        except (socket.error,
-                requests.exceptions.HTTPError,
-                requests.exceptions.ConnectionError,
-                requests.exceptions.InvalidURL,
-                xmlrpc.client.ProtocolError) as e:
-            swrite(FLAG_HEAD_EXCEPT)    
-            swrite("Connection lost/failed - %s: %s" %(e.__class__.__name__,str(e)))
-            swrite(FLAG_TAIL_EXCEPT)
-            bz_REFRESH = True
-            continue
+class _MIUnixServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _MITCPServer(socketserver.ThreadingMixIn,
+                   socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _serve_daemon(dopt, parser, unittest_bz_instance):
+    """ Run MI as a daemon serving many clients at once
+
+    All clients share the cached `Bugzilla` instances,
+    and with them the HTTP connection pools.
+    """
+    if threading.current_thread() is threading.main_thread():
+        # Exit through the cleanup below, like on KeyboardInterrupt
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    servers = []
+    if dopt.unix_socket:
+        if _is_socket(dopt.unix_socket):
+            # Left over by a daemon that didn't exit cleanly,
+            # _main checked that nobody listens on it
+            os.unlink(dopt.unix_socket)
+        # Whoever can connect acts with our credentials
+        oldmask = os.umask(0o077)
+        try:
+            servers.append(_MIUnixServer(dopt.unix_socket, _MIRequestHandler))
+        finally:
+            os.umask(oldmask)
+    if dopt.tcp_port is not None:
+        servers.append(_MITCPServer(("127.0.0.1", dopt.tcp_port),
+                                    _MIRequestHandler))
+
+    threads = []
+    for server in servers:
+        server.mi_parser = parser
+        server.mi_unittest_bz_instance = unittest_bz_instance
+        log.info("MI daemon listening on %s", server.server_address)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name="bzmi-daemon", daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        if dopt.unix_socket and _is_socket(dopt.unix_socket):
+            os.unlink(dopt.unix_socket)
+
+
+def _is_socket(path):
+    try:
+        return stat.S_ISSOCK(os.lstat(path).st_mode)
+    except FileNotFoundError:
+        return False
+
+
+def _is_stale_socket(path):
+    """ Whether `path` is a socket nobody listens on anymore
+    """
+    if not _is_socket(path):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except ConnectionRefusedError:
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return False
+
+
+def _main(unittest_bz_instance, argv=None):
+    """ (Patched version)
+
+    `argv` are the options of `bugzilla-mi` itself, only parsed
+    when running it from the command line
+    """
+    dopt = None
+    if argv is not None:
+        dparser = _setup_daemon_parser()
+        dopt = dparser.parse_args(argv)
+        if (dopt.unix_socket and os.path.lexists(dopt.unix_socket) and
+                not _is_stale_socket(dopt.unix_socket)):
+            dparser.error("--unix-socket: %s exists and is not a socket "
+                          "left over by a stopped daemon" % dopt.unix_socket)
+
+    # init argparser & logger
+    setup_logging()
+    parser = setup_parser()
+    if dopt and (dopt.unix_socket or dopt.tcp_port is not None):
+        _serve_daemon(dopt, parser, unittest_bz_instance)
+        return
+    session = _MISession(sys.stdin, sys.stdout)
+    _serve(session, parser, unittest_bz_instance)
 
 
-def main(unittest_bz_instance=None):
+def main(unittest_bz_instance=None, argv=None):
     """ (Patched version)
     """
     try:
-        _main(unittest_bz_instance)
+        _main(unittest_bz_instance, argv)
     except KeyboardInterrupt:
         swrite(FLAG_HEAD_STRING)
         swrite("Exited at user request")
@@ -689,4 +1788,4 @@ def main(unittest_bz_instance=None):
 
 
 def mi():
-    main()
+    main(argv=sys.argv[1:])
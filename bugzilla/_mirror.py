@@ -0,0 +1,288 @@
+# This work is licensed under the GNU GPLv2 or later.
+# See the COPYING file in the top-level directory.
+
+import base64
+import collections.abc
+import datetime
+import json
+from logging import getLogger
+import os
+import sqlite3
+import threading
+import time
+
+from .exceptions import BugzillaError
+from ._util import listify
+
+log = getLogger(__name__)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS syncs (
+    name TEXT PRIMARY KEY,
+    query TEXT NOT NULL,
+    high_water TEXT,
+    synced REAL
+);
+CREATE TABLE IF NOT EXISTS bugs (
+    id INTEGER PRIMARY KEY,
+    product TEXT,
+    component TEXT,
+    status TEXT,
+    assigned_to TEXT,
+    last_change_time TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bugs_product ON bugs (product, component);
+CREATE INDEX IF NOT EXISTS bugs_status ON bugs (status);
+CREATE INDEX IF NOT EXISTS bugs_assigned_to ON bugs (assigned_to);
+CREATE INDEX IF NOT EXISTS bugs_last_change_time ON bugs (last_change_time);
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY,
+    bug_id INTEGER NOT NULL,
+    count INTEGER,
+    creator TEXT,
+    time TEXT,
+    is_private INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS comments_bug_id ON comments (bug_id, count);
+CREATE TABLE IF NOT EXISTS flags (
+    bug_id INTEGER NOT NULL,
+    name TEXT,
+    status TEXT,
+    setter TEXT,
+    requestee TEXT
+);
+CREATE INDEX IF NOT EXISTS flags_bug_id ON flags (bug_id);
+CREATE INDEX IF NOT EXISTS flags_name ON flags (name, status);
+"""
+
+
+def _json_default(obj):
+    if isinstance(obj, collections.abc.Mapping):
+        # Bug.get_raw_data_view()
+        return dict(obj)
+    if "DateTime" in str(obj.__class__):
+        # xmlrpc DateTime object, store it the way REST returns it
+        dobj = datetime.datetime.strptime(str(obj), '%Y%m%dT%H:%M:%S')
+        return dobj.isoformat() + "Z"
+    if "Binary" in str(obj.__class__):
+        return base64.b64encode(obj.data).decode("utf-8")
+    raise TypeError("Unexpected JSON conversion class=%s" % obj.__class__)
+
+
+def _to_text(val):
+    if val is None or isinstance(val, str):
+        return val
+    return json.loads(json.dumps(val, default=_json_default))
+
+
+class _BugzillaMirror(object):
+    """
+    Local SQLite copy of the bugs matching some queries of one bugzilla
+    instance. After the initial load, sync() only pulls the bugs whose
+    last_change_time is newer than the high-water mark of the previous
+    sync of the same query.
+
+    Bug data is stored as the raw API dicts, with the most used fields,
+    comments and flags also in indexed columns and tables.
+    """
+    def __init__(self, path):
+        self._path = os.path.expanduser(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self._path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get_url(self):
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'url'").fetchone()
+        return row and row[0]
+
+    def _check_url(self, url):
+        mirrorurl = self.get_url()
+        if mirrorurl is None:
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('url', ?)", (url,))
+        elif mirrorurl != url:
+            raise BugzillaError("Mirror %s belongs to %s, not %s" %
+                                (self._path, mirrorurl, url))
+
+
+    ###########
+    # Syncing #
+    ###########
+
+    def sync(self, bz, query, name=None, with_comments=True, page_size=500):
+        """
+        Pull the bugs matching query into the mirror, and their comments
+        if with_comments. The first sync of a query loads everything,
+        later ones only the bugs changed since the previous sync.
+
+        :param name: Identifies the query for its high-water mark.
+            Defaults to the query itself.
+        :returns: dict with the number of bugs and comments stored
+            and the new high-water mark
+        """
+        querytext = json.dumps(query, sort_keys=True, default=str)
+        name = name or querytext
+        with self._lock:
+            self._check_url(bz.url)
+            row = self._conn.execute(
+                "SELECT high_water FROM syncs WHERE name = ?",
+                (name,)).fetchone()
+        high_water = row and row[0]
+
+        query = query.copy()
+        if high_water:
+            # Bugzilla matches last_change_time >= high_water, so bugs
+            # changed in the same second are fetched again, harmlessly
+            query["last_change_time"] = high_water
+        log.debug("Mirror sync of %s since %s", name, high_water)
+
+        # Taken before paging, so bugs changed while we page are newer
+        # and get fetched by the next sync even if we already passed them
+        high_water = self._get_high_water(bz, query) or high_water
+
+        nbugs = 0
+        ncomments = 0
+        for page in bz._query_pages(query, page_size, readahead=True,
+                                    by_id=True):
+            bugs = [b.get_raw_data_view() for b in page]
+            comments = {}
+            if with_comments:
+                comments = bz.get_comments([b["id"] for b in bugs])["bugs"]
+            with self._lock, self._conn:
+                for bugdict in bugs:
+                    self._store_bug(bugdict)
+                    if with_comments:
+                        ncomments += self._store_comments(bugdict["id"],
+                            comments[str(bugdict["id"])]["comments"])
+            nbugs += len(bugs)
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO syncs "
+                "(name, query, high_water, synced) VALUES (?, ?, ?, ?)",
+                (name, querytext, high_water, time.time()))
+        return {"bugs": nbugs, "comments": ncomments,
+                "high_water": high_water}
+
+    @staticmethod
+    def _get_high_water(bz, query):
+        # The newest last_change_time of the bugs matching query
+        probe = query.copy()
+        probe.update({"order": "changeddate DESC", "limit": 1,
+                      "include_fields": ["id", "last_change_time"]})
+        for key in ["offset", "exclude_fields", "extra_fields"]:
+            probe.pop(key, None)
+        bugs = bz._backend.bug_search(probe)["bugs"]
+        return bugs and _to_text(bugs[0].get("last_change_time")) or None
+
+    def _store_bug(self, bugdict):
+        data = json.loads(json.dumps(bugdict, default=_json_default))
+        self._conn.execute(
+            "INSERT OR REPLACE INTO bugs (id, product, component, status, "
+            "assigned_to, last_change_time, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (data["id"], data.get("product"),
+             listify(data.get("component") or [None])[0],
+             data.get("status"), data.get("assigned_to"),
+             data.get("last_change_time"), json.dumps(data)))
+
+        if "flags" not in data:
+            return
+        self._conn.execute("DELETE FROM flags WHERE bug_id = ?",
+                           (data["id"],))
+        self._conn.executemany(
+            "INSERT INTO flags (bug_id, name, status, setter, requestee) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(data["id"], f.get("name"), f.get("status"),
+              f.get("setter"), f.get("requestee"))
+             for f in data["flags"]])
+
+    def _store_comments(self, bug_id, comments):
+        comments = json.loads(json.dumps(comments, default=_json_default))
+        self._conn.execute("DELETE FROM comments WHERE bug_id = ?",
+                           (bug_id,))
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO comments "
+            "(id, bug_id, count, creator, time, is_private, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(c["id"], bug_id, c.get("count"),
+              c.get("creator") or c.get("author"),
+              c.get("time") or c.get("creation_time"),
+              int(bool(c.get("is_private"))), json.dumps(c))
+             for c in comments])
+        return len(comments)
+
+
+    ###########
+    # Reading #
+    ###########
+
+    def _attach_comments(self, bugs):
+        for bugdict in bugs:
+            rows = self._conn.execute(
+                "SELECT data FROM comments WHERE bug_id = ? "
+                "ORDER BY count, id", (bugdict["id"],)).fetchall()
+            bugdict["comments"] = [json.loads(r[0]) for r in rows]
+        return bugs
+
+    def get(self, idlist, with_comments=False):
+        """
+        Return the raw bug dict of each id in idlist, or None for
+        the ones not in the mirror
+        """
+        ret = []
+        with self._lock:
+            for bugid in idlist:
+                row = self._conn.execute(
+                    "SELECT data FROM bugs WHERE id = ?",
+                    (int(bugid),)).fetchone()
+                ret.append(row and json.loads(row[0]))
+            if with_comments:
+                self._attach_comments([b for b in ret if b])
+        return ret
+
+    def query(self, ids=None, product=None, component=None, status=None,
+              assigned_to=None, flag=None, with_comments=False):
+        """
+        Return the raw bug dicts in the mirror matching all the
+        passed values, ordered by bug id. Each value may be a list
+        of alternatives. flag matches flag names.
+        """
+        where = []
+        params = []
+        for column, val in [("id", ids), ("product", product),
+                            ("component", component), ("status", status),
+                            ("assigned_to", assigned_to)]:
+            val = listify(val)
+            if not val:
+                continue
+            where.append("%s IN (%s)" % (column, ",".join("?" * len(val))))
+            params += val
+        flag = listify(flag)
+        if flag:
+            where.append("id IN (SELECT bug_id FROM flags WHERE name IN (%s))"
+                         % ",".join("?" * len(flag)))
+            params += flag
+
+        sql = "SELECT data FROM bugs"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id"
+        with self._lock:
+            ret = [json.loads(r[0]) for r in
+                   self._conn.execute(sql, params).fetchall()]
+            if with_comments:
+                self._attach_comments(ret)
+        return ret
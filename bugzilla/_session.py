@@ -4,16 +4,252 @@
 from logging import getLogger
 
 import os
+import random
 import sys
+import threading
+import time
 import urllib.parse
 
 import requests
+import requests.adapters
 
-from .exceptions import BugzillaHTTPError
+from .exceptions import BugzillaCircuitOpenError, BugzillaHTTPError
 
 log = getLogger(__name__)
 
 
+# HTTP status codes of failures worth retrying, usually from
+# a proxy in front of a restarting or overloaded bugzilla
+_RETRY_STATUSES = [429, 502, 503, 504]
+_IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS"]
+
+
+def _get_env_number(name, default):
+    val = os.environ.get(name)
+    return float(val) if val else default
+
+
+class _CircuitBreaker(object):
+    """
+    Per-host circuit breaker. After `threshold` failed requests in a
+    row, the circuit opens and requests fail fast for `cooldown`
+    seconds. Then a single trial request is let through: success
+    closes the circuit, failure opens it again.
+    """
+    _breakers = {}
+    _breakers_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, host):
+        with cls._breakers_lock:
+            if host not in cls._breakers:
+                cls._breakers[host] = cls(host)
+            return cls._breakers[host]
+
+    def __init__(self, host):
+        self.host = host
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened = None
+        self._trial = False
+
+    @staticmethod
+    def _get_threshold():
+        return int(_get_env_number("PYTHONBUGZILLA_CIRCUIT_THRESHOLD", 5))
+
+    @staticmethod
+    def _get_cooldown():
+        return _get_env_number("PYTHONBUGZILLA_CIRCUIT_COOLDOWN", 30)
+
+    def check(self):
+        """
+        Raise BugzillaCircuitOpenError if requests to the host
+        shouldn't be attempted now
+
+        :returns: True if the caller got the trial request, and must
+            call release_trial() once it is done with it
+        """
+        with self._lock:
+            if self._opened is None:
+                return False
+            remaining = self._opened + self._get_cooldown() - time.monotonic()
+            if remaining <= 0 and not self._trial:
+                # Half open, let this one through
+                self._trial = True
+                return True
+        raise BugzillaCircuitOpenError(
+            "%s failed %d requests in a row, not retrying for %ds" %
+            (self.host, self._failures, max(1, round(remaining))))
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            threshold = self._get_threshold()
+            if self._trial or (threshold > 0 and
+                               self._failures >= threshold):
+                if self._opened is None or self._trial:
+                    log.debug("Opening circuit of %s after %d failures",
+                              self.host, self._failures)
+                self._opened = time.monotonic()
+                self._trial = False
+
+    def release_trial(self):
+        """
+        Let another trial request through, in case the previous one
+        ended without recording a success or a failure
+        """
+        with self._lock:
+            self._trial = False
+
+
+class _RateLimiter(object):
+    """
+    Per-host token bucket shared by every session and thread of the
+    process. Each request takes a token, tokens come back at `rate`
+    per second and up to `burst` can be saved. A rate of 0 means
+    no limit.
+
+    Limits come from set_limit() for the host, else set_limit() for
+    all hosts, else $PYTHONBUGZILLA_RATE_LIMIT and
+    $PYTHONBUGZILLA_RATE_BURST.
+    """
+    _limiters = {}
+    _limits = {}
+    _limiters_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, host):
+        with cls._limiters_lock:
+            if host not in cls._limiters:
+                cls._limiters[host] = cls(host)
+            return cls._limiters[host]
+
+    @classmethod
+    def set_limit(cls, rate, burst=None, host=None):
+        """
+        Set the rate and burst of host, or of all hosts without
+        their own limit if host is None. A None rate drops the
+        setting.
+        """
+        with cls._limiters_lock:
+            if rate is None:
+                cls._limits.pop(host, None)
+            else:
+                cls._limits[host] = (max(0.0, float(rate)),
+                                     burst and max(1, int(burst)) or None)
+
+    @classmethod
+    def get_limit(cls, host=None):
+        """
+        Return the (rate, burst) applying to host
+        """
+        with cls._limiters_lock:
+            limit = cls._limits.get(host) or cls._limits.get(None)
+        if limit:
+            rate, burst = limit
+        else:
+            rate = _get_env_number("PYTHONBUGZILLA_RATE_LIMIT", 0)
+            burst = _get_env_number("PYTHONBUGZILLA_RATE_BURST", 0)
+        return rate, int(burst or max(1, rate))
+
+    @classmethod
+    def stats(cls):
+        with cls._limiters_lock:
+            limiters = list(cls._limiters.values())
+        rate, burst = cls.get_limit()
+        ret = {"rate": rate, "burst": burst, "hosts": {}}
+        for limiter in limiters:
+            rate, burst = cls.get_limit(limiter.host)
+            ret["hosts"][limiter.host] = {
+                "rate": rate, "burst": burst,
+                "requests": limiter.requests,
+                "waited": round(limiter.waited, 3)}
+        return ret
+
+    def __init__(self, host):
+        self.host = host
+        self._lock = threading.Lock()
+        self._tokens = None
+        self._last = None
+        self.requests = 0
+        self.waited = 0.0
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available
+        """
+        while True:
+            with self._lock:
+                rate, burst = self.get_limit(self.host)
+                now = time.monotonic()
+                if self._tokens is None or not rate:
+                    self._tokens = float(burst)
+                else:
+                    self._tokens = min(float(burst), self._tokens +
+                                       (now - self._last) * rate)
+                self._last = now
+                if not rate or self._tokens >= 1:
+                    self._tokens -= 1
+                    self.requests += 1
+                    return
+                wait = (1 - self._tokens) / rate
+                self.waited += wait
+            time.sleep(wait)
+
+
+class _HTTPAdapterRegistry(object):
+    """
+    Process-wide requests HTTPAdapter per scheme, host and TLS
+    settings. It is mounted on every requests session we create, so
+    all instances for a host, including ones rebuilt after errors,
+    reuse the same keep-alive and TLS connections.
+
+    Sessions only share the connection pools this way, not their
+    headers, cookies or auth. Sessions with different verify or cert
+    never share an adapter: requests before 2.32 reuses pooled
+    connections without checking them (CVE-2024-35195), so an
+    unverified connection could otherwise serve a verifying session.
+    Pool sizes come from
+    $PYTHONBUGZILLA_POOL_CONNECTIONS and $PYTHONBUGZILLA_POOL_MAXSIZE.
+    """
+    _adapters = {}
+    _adapters_lock = threading.Lock()
+
+    @staticmethod
+    def _get_prefix(url):
+        parsed = urllib.parse.urlparse(url)
+        return "%s://%s/" % (parsed.scheme, parsed.netloc)
+
+    @classmethod
+    def get(cls, url, verify=True, cert=None):
+        key = (cls._get_prefix(url), repr(verify), repr(cert))
+        with cls._adapters_lock:
+            if key not in cls._adapters:
+                cls._adapters[key] = requests.adapters.HTTPAdapter(
+                    pool_connections=int(_get_env_number(
+                        "PYTHONBUGZILLA_POOL_CONNECTIONS", 4)),
+                    pool_maxsize=int(_get_env_number(
+                        "PYTHONBUGZILLA_POOL_MAXSIZE", 10)))
+            return cls._adapters[key]
+
+    @classmethod
+    def mount(cls, session, url):
+        """
+        Make session use the shared adapter of the host of url and
+        of the verify and cert already set on session. Don't close()
+        such a session, it would drop the shared connections.
+        """
+        session.mount(cls._get_prefix(url),
+                      cls.get(url, session.verify, session.cert))
+        return session
+
+
 class _BugzillaSession(object):
     """
     Class to handle the backend agnostic 'requests' setup
@@ -29,6 +265,8 @@ class _BugzillaSession(object):
         self._api_key = api_key
         self._is_xmlrpc = False
         self._use_auth_bearer = False
+        self._concurrency = None
+        self._rejected_callback = None
 
         if self._scheme not in ["http", "https"]:
             raise ValueError("Invalid URL scheme: %s (%s)" % (
@@ -42,6 +280,8 @@ class _BugzillaSession(object):
             self._session.cert = cert
         if sslverify is False:
             self._session.verify = False
+        if not requests_session:
+            self._session = _HTTPAdapterRegistry.mount(self._session, url)
         self._session.headers["User-Agent"] = self._user_agent
 
         if is_redhat_bugzilla and self._api_key:
@@ -57,6 +297,24 @@ class _BugzillaSession(object):
         envtimeout = os.environ.get("PYTHONBUGZILLA_REQUESTS_TIMEOUT")
         return float(envtimeout or DEFAULT_TIMEOUT)
 
+    def set_rejected_callback(self, callback):
+        """
+        callback() is run when the server answers a request with an
+        HTTP error that isn't worth retrying
+        """
+        self._rejected_callback = callback
+
+    def get_concurrency(self):
+        # Max number of requests a single API call may have in flight,
+        # for REST calls that need one request per id
+        DEFAULT_CONCURRENCY = 4
+        if self._concurrency is not None:
+            return self._concurrency
+        envconcurrency = os.environ.get("PYTHONBUGZILLA_REQUESTS_CONCURRENCY")
+        return max(1, int(envconcurrency or DEFAULT_CONCURRENCY))
+    def set_concurrency(self, val):
+        self._concurrency = None if val is None else max(1, int(val))
+
     def set_rest_defaults(self):
         self._session.headers["Content-Type"] = "application/json"
     def set_xmlrpc_defaults(self):
@@ -93,7 +351,88 @@ class _BugzillaSession(object):
     def get_requests_session(self):
         return self._session
 
-    def request(self, *args, **kwargs):
+    @staticmethod
+    def _get_retries():
+        return int(_get_env_number("PYTHONBUGZILLA_REQUESTS_RETRIES", 2))
+
+    @staticmethod
+    def _get_backoff(attempt, error):
+        # Exponential backoff with full jitter, or what the server
+        # asked for with Retry-After, up to the cap
+        base = _get_env_number("PYTHONBUGZILLA_REQUESTS_BACKOFF", 0.5)
+        cap = _get_env_number("PYTHONBUGZILLA_REQUESTS_BACKOFF_MAX", 30)
+        delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+
+        response = getattr(error, "response", None)
+        retryafter = response is not None and \
+            response.headers.get("Retry-After") or ""
+        if retryafter.isdigit():
+            delay = max(delay, min(cap, float(retryafter)))
+        return delay
+
+    @staticmethod
+    def _is_transient_error(e):
+        if isinstance(e, requests.exceptions.SSLError):
+            # Certificate problems won't go away by retrying
+            return False
+        if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+            return True
+        status = getattr(getattr(e, "response", None), "status_code", None)
+        return status in _RETRY_STATUSES
+
+    def request(self, method, url, *args, idempotent=None, **kwargs):
+        """
+        Send the request, retrying it with backoff on connection errors,
+        timeouts and 429/502/503/504 if it is idempotent, which defaults
+        to GET, HEAD and OPTIONS requests. Requests to a host that keeps
+        failing are refused by its circuit breaker, and every attempt
+        waits for the rate limiter of its host.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in _IDEMPOTENT_METHODS
+        retries = idempotent and max(0, self._get_retries()) or 0
+        host = urllib.parse.urlparse(url).netloc
+        breaker = _CircuitBreaker.get(host)
+        limiter = _RateLimiter.get(host)
+
+        # Retries of a request that got through don't ask the breaker
+        # again, and count as one failure once they are used up
+        trial = breaker.check()
+        try:
+            attempt = 0
+            while True:
+                limiter.acquire()
+                try:
+                    response = self._request(method, url, *args, **kwargs)
+                except Exception as e:
+                    if not self._is_transient_error(e):
+                        if getattr(e, "response", None) is not None:
+                            # The server is up, it just didn't like
+                            # the request
+                            breaker.record_success()
+                            if self._rejected_callback:
+                                self._rejected_callback()
+                        elif not isinstance(e,
+                                            requests.exceptions.SSLError):
+                            breaker.record_failure()
+                        raise
+                    if attempt >= retries:
+                        breaker.record_failure()
+                        raise
+                    delay = self._get_backoff(attempt, e)
+                    log.debug("%s %s failed with %s, retry %d/%d in %.2fs",
+                              method, url, e.__class__.__name__,
+                              attempt + 1, retries, delay)
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+                breaker.record_success()
+                return response
+        finally:
+            if trial:
+                breaker.release_trial()
+
+    def _request(self, *args, **kwargs):
         timeout = self._get_timeout()
         if "timeout" not in kwargs:
             kwargs["timeout"] = timeout
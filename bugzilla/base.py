@@ -7,21 +7,30 @@
 # See the COPYING file in the top-level directory.
 
 import collections
+import concurrent.futures
+import copy
+import datetime
 import getpass
 import locale
 from logging import getLogger
 import mimetypes
 import os
+import re
 import sys
+import threading
+import time
 import urllib.parse
 
 from io import BytesIO
 
+import requests
+
 from ._authfiles import _BugzillaRCFile, _BugzillaTokenCache
 from .apiversion import __version__
 from ._backendrest import _BackendREST
 from ._backendxmlrpc import _BackendXMLRPC
-from .bug import Bug, Group, User
+from .bug import Bug, Group, User, _bug_alias_map
+from ._diskcache import _BugzillaConnectCache, _BugzillaMetadataCache
 from .exceptions import BugzillaError
 from ._rhconverters import _RHBugzillaConverters
 from ._session import _BugzillaSession
@@ -41,6 +50,55 @@ def _nested_update(d, u):
     return d
 
 
+def _order_like(objs, keys, getkey):
+    """
+    Return objs with, for each of keys in turn, the first object not
+    returned yet whose getkey() matches, then the unmatched ones.
+    """
+    index = {}
+    for pos, obj in enumerate(objs):
+        index.setdefault(getkey(obj), collections.deque()).append(pos)
+    used = [False] * len(objs)
+    ret = []
+    for key in keys:
+        positions = index.get(key)
+        if positions:
+            pos = positions.popleft()
+            used[pos] = True
+            ret.append(objs[pos])
+    ret += [obj for pos, obj in enumerate(objs) if not used[pos]]
+    return ret
+
+
+def _is_timeout_error(e):
+    # The client or a proxy in front of bugzilla gave up on the request
+    if isinstance(e, requests.exceptions.Timeout):
+        return True
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    status = status or getattr(e, "errcode", None)
+    return status in [502, 503, 504]
+
+
+def _is_oversize_error(e):
+    # The request was too large or too slow for the server
+    if _is_timeout_error(e):
+        return True
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    status = status or getattr(e, "errcode", None)
+    return status in [413, 414]
+
+
+def _parse_bug_time(val):
+    # creation_time as returned by REST or XMLRPC, as a datetime
+    val = str(val)
+    for fmt in ["%Y-%m-%dT%H:%M:%SZ", "%Y%m%dT%H:%M:%S"]:
+        try:
+            return datetime.datetime.strptime(val, fmt)
+        except ValueError:
+            continue
+    raise BugzillaError("Unexpected bug time format: %s" % val)
+
+
 class _FieldAlias(object):
     """
     Track API attribute names that differ from what we expose in users.
@@ -75,6 +133,42 @@ class _BugzillaAPICache(object):
         self.version_raw = None
         self.version_parsed = (0, 0)
 
+        # time.time() of the last refresh, for each product name,
+        # and of the last refresh of the whole product list
+        self.products_refreshed = {}
+        self.products_all_refreshed = None
+
+
+class _BugzillaBugCache(object):
+    """
+    Size bounded LRU cache of raw bug data, keyed by URL, bug id
+    and the include/exclude/extra fields it was fetched with.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                return None
+            self._entries.move_to_end(key)
+        return copy.deepcopy(data)
+
+    def put(self, key, data):
+        data = copy.deepcopy(data)
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
 
 class Bugzilla(object):
     """
@@ -174,7 +268,9 @@ class Bugzilla(object):
     def __init__(self, url=-1, user=None, password=None, cookiefile=-1,
                  sslverify=True, tokenfile=-1, use_creds=True, api_key=None,
                  cert=None, configpaths=-1,
-                 force_rest=False, force_xmlrpc=False, requests_session=None):
+                 force_rest=False, force_xmlrpc=False, requests_session=None,
+                 metadatacache=None, metadatacache_ttl=None,
+                 bugcache=0):
         """
         :param url: The bugzilla instance URL, which we will connect
             to immediately. Most users will want to specify this at
@@ -207,6 +303,18 @@ class Bugzilla(object):
         :param requests_session: An optional requests.Session object the
             API will use to contact the remote bugzilla instance. This
             way the API user can set up whatever auth bits they may need.
+        :param metadatacache: Directory to persist products, component
+            names and bug fields in, so a new instance doesn't have to
+            fetch them again. If -1, use the default path. If None,
+            only cache them in memory.
+        :param metadatacache_ttl: Seconds a persisted entry stays valid,
+            86400 if None. Passing it or metadatacache also caches the
+            server version and backend probe results of connect() for
+            that long, see connect().
+        :param bugcache: Max number of bugs to keep fetched data of.
+            Cached bugs are returned by getbug(s) after checking that
+            their last_change_time didn't change on the server. If 0,
+            every getbug(s) fetches the full data.
         """
         if url == -1:
             raise TypeError("Specify a valid bugzilla url, or pass url=None")
@@ -225,6 +333,23 @@ class Bugzilla(object):
         self._cache = _BugzillaAPICache()
         self._bug_autorefresh = False
         self._is_redhat_bugzilla = False
+        self._alias_tables = {}
+        self._requests_concurrency = None
+        self._getbugs_chunk_size = 200
+
+        if metadatacache == -1:
+            metadatacache = _BugzillaMetadataCache.get_default_path()
+        self._metadatacache_path = metadatacache
+        self._metadatacache_ttl = metadatacache_ttl
+        if metadatacache_ttl is None:
+            self._metadatacache_ttl = 86400
+        self._connectcache = bool(metadatacache or
+                                  metadatacache_ttl is not None)
+        self._connectcache_used = False
+        self._connectcache_lock = threading.Lock()
+        self._connect_url = None
+        self._diskcache = None
+        self._bugcache = bugcache and _BugzillaBugCache(bugcache) or None
 
         self._rcfile = _BugzillaRCFile()
         self._tokencache = _BugzillaTokenCache()
@@ -347,13 +472,31 @@ class Bugzilla(object):
         """
         return float("%d.%d" % (self.bz_ver_major, self.bz_ver_minor))
 
+    def _get_alias_tables(self):
+        # The alias lists only depend on the redhat mode, so build
+        # them once per mode and share them with every Bug
+        key = self._is_redhat_bugzilla
+        tables = self._alias_tables.get(key)
+        if tables is None:
+            aliases = self._get_field_aliases()
+            bug = tuple((f.newname, f.oldname) for f in aliases if f.is_bug)
+            tables = {
+                "bug": bug,
+                "api": tuple((f.newname, f.oldname)
+                             for f in aliases if f.is_api),
+                "bugmap": _bug_alias_map(bug),
+            }
+            self._alias_tables[key] = tables
+        return tables
+
     def _get_bug_aliases(self):
-        return [(f.newname, f.oldname)
-                for f in self._get_field_aliases() if f.is_bug]
+        return self._get_alias_tables()["bug"]
+
+    def _get_bug_alias_map(self):
+        return self._get_alias_tables()["bugmap"]
 
     def _get_api_aliases(self):
-        return [(f.newname, f.oldname)
-                for f in self._get_field_aliases() if f.is_api]
+        return self._get_alias_tables()["api"]
 
 
     #################
@@ -470,11 +613,22 @@ class Bugzilla(object):
             return _BackendREST, resturl
 
         # We were passed something like bugzilla.example.com but we
-        # aren't sure which method to use, try probing
-        if _BackendXMLRPC.probe(xmlurl):
-            return _BackendXMLRPC, xmlurl
-        if _BackendREST.probe(resturl):
-            return _BackendREST, resturl
+        # aren't sure which method to use, try probing, unless we
+        # already did recently
+        backends = {"xmlrpc": _BackendXMLRPC, "rest": _BackendREST}
+        cached = self._connectcache and _BugzillaConnectCache.get(
+            "probe", url, self._metadatacache_ttl, self._metadatacache_path)
+        if cached and cached[0] in backends:
+            log.debug("Using cached probe result for url=%s", url)
+            self._connectcache_used = True
+            return backends[cached[0]], cached[1]
+
+        for name, probeurl in [("xmlrpc", xmlurl), ("rest", resturl)]:
+            if backends[name].probe(probeurl):
+                if self._connectcache:
+                    _BugzillaConnectCache.set("probe", url,
+                        [name, probeurl], self._metadatacache_path)
+                return backends[name], probeurl
 
         # Otherwise fallback to XMLRPC default and let it fail
         return _BackendXMLRPC, xmlurl
@@ -490,11 +644,19 @@ class Bugzilla(object):
 
         If 'user' and 'password' are both set, we'll run login(). Otherwise
         you'll have to login() yourself before some methods will work.
+
+        If metadatacache or metadatacache_ttl were passed, the server
+        version, and the backend found by probing a bare hostname, are
+        reused from earlier connects to the same URL. When the server
+        then rejects a request, the version is fetched again, and if
+        that fails too the cached results are dropped.
         """
         if self._session:
             self.disconnect()
 
         url = url or self.url
+        self._connect_url = url
+        self._connectcache_used = False
         backendclass, newurl = self._get_backend_class(url)
         if url != newurl:
             log.debug("Converted url=%s to fixed url=%s", url, newurl)
@@ -514,7 +676,11 @@ class Bugzilla(object):
                 api_key=self.api_key,
                 is_redhat_bugzilla=self._is_redhat_bugzilla,
                 requests_session=self._user_requests_session)
+        self._session.set_concurrency(self._requests_concurrency)
         self._backend = backendclass(self.url, self._session)
+        if self._connectcache:
+            self._session.set_rejected_callback(
+                self._revalidate_connectcache)
 
         if (self.user and self.password):
             log.info("user and password present - doing login()")
@@ -523,10 +689,91 @@ class Bugzilla(object):
         if self.api_key:
             log.debug("using API key")
 
-        version = self._backend.bugzilla_version()["version"]
+        version = self._connectcache and _BugzillaConnectCache.get(
+            "version", self.url,
+            self._metadatacache_ttl, self._metadatacache_path)
+        if version:
+            self._connectcache_used = True
+        else:
+            version = self._backend.bugzilla_version()["version"]
+            if self._connectcache:
+                _BugzillaConnectCache.set("version", self.url, version,
+                        self._metadatacache_path)
         log.debug("Bugzilla version string: %s", version)
         self._set_bz_version(version)
 
+        if self._metadatacache_path:
+            self._load_diskcache()
+
+    def _revalidate_connectcache(self):
+        """
+        Run when the server rejects a request: if connect() used cached
+        results, fetch the version again, and drop the cached results
+        if that fails too. Only done once per connect().
+        """
+        with self._connectcache_lock:
+            if not self._connectcache_used:
+                return
+            self._connectcache_used = False
+
+        path = self._metadatacache_path
+        try:
+            version = self._backend.bugzilla_version()["version"]
+        except Exception as e:
+            log.debug("Dropping cached connect results of %s: %s",
+                      self._connect_url, e)
+            _BugzillaConnectCache.delete("probe", self._connect_url, path)
+            _BugzillaConnectCache.delete("version", self.url, path)
+            return
+
+        _BugzillaConnectCache.set("version", self.url, version, path)
+        if version == self._cache.version_raw:
+            return
+        log.debug("Bugzilla version changed from %s to %s",
+                  self._cache.version_raw, version)
+        self._cache = _BugzillaAPICache()
+        self._set_bz_version(version)
+        if path:
+            self._load_diskcache()
+
+    def _load_diskcache(self):
+        """
+        Fill the in-memory API cache from the on-disk metadata cache
+        """
+        self._diskcache = _BugzillaMetadataCache(
+            self._metadatacache_path, self.url, self._metadatacache_ttl)
+        self._diskcache.load(self._cache.version_raw)
+
+        products = self._diskcache.get("products")
+        if products:
+            self._cache.products = products
+            refreshed = self._diskcache.get("products_refreshed") or {}
+            self._cache.products_refreshed = refreshed.get("names") or {}
+            self._cache.products_all_refreshed = refreshed.get("all")
+        component_names = self._diskcache.get("component_names")
+        if component_names:
+            self._cache.component_names = dict(
+                (prodid, names) for prodid, names in component_names)
+        bugfields = self._diskcache.get("bugfields")
+        if bugfields:
+            self._cache.bugfields = bugfields
+        log.debug("Loaded metadata cache %s", self._diskcache.get_filename())
+
+    def _save_diskcache(self, name):
+        if not self._diskcache:
+            return
+        if name == "products":
+            self._diskcache.update({
+                name: self._cache.products,
+                "products_refreshed": {
+                    "names": self._cache.products_refreshed,
+                    "all": self._cache.products_all_refreshed}})
+        elif name == "component_names":
+            self._diskcache.set(name,
+                    list(self._cache.component_names.items()))
+        elif name == "bugfields":
+            self._diskcache.set(name, self._cache.bugfields)
+
 
     @property
     def _proxy(self):
@@ -567,6 +814,9 @@ class Bugzilla(object):
         self._backend = None
         self._session = None
         self._cache = _BugzillaAPICache()
+        self._diskcache = None
+        if self._bugcache:
+            self._bugcache.clear()
 
     def login(self, user=None, password=None, restrict_login=None):
         """
@@ -746,6 +996,7 @@ class Bugzilla(object):
             self._cache.bugfields = _fieldnames()
             self._cache.bugfields.sort()
             log.debug("bugfields = %s", self._cache.bugfields)
+            self._save_diskcache("bugfields")
 
         return self._cache.bugfields
     bugfields = property(fget=lambda self: self.getbugfields(),
@@ -815,7 +1066,16 @@ class Bugzilla(object):
         info for products foo, bar, baz. Individual product fields are
         also updated.
         """
+        now = time.time()
+        if not kwargs.get("ids") and not kwargs.get("names"):
+            self._cache.products_all_refreshed = now
+
         for product in self.product_get(**kwargs):
+            if "name" in product:
+                self._cache.products_refreshed[product["name"]] = now
+            if "components" in product:
+                # Let getcomponents() pick up the new list
+                self._cache.component_names.pop(product.get("id"), None)
             updated = False
             for current in self._cache.products[:]:
                 if (current.get("id", -1) != product.get("id", -2) and
@@ -827,6 +1087,7 @@ class Bugzilla(object):
                 break
             if not updated:
                 self._cache.products.append(product)
+        self._save_diskcache("products")
 
     def getproducts(self, force_refresh=False, **kwargs):
         """
@@ -928,6 +1189,7 @@ class Bugzilla(object):
                 if name:
                     names.append(name)
             self._cache.component_names[product_id] = names
+            self._save_diskcache("component_names")
 
         return self._cache.component_names[product_id]
 
@@ -1034,6 +1296,40 @@ class Bugzilla(object):
         self._bug_autorefresh = bool(val)
     bug_autorefresh = property(_get_bug_autorefresh, _set_bug_autorefresh)
 
+    def _get_requests_concurrency(self):
+        """
+        Max number of requests sent at the same time by a single API
+        call which the REST API can only serve one id per request,
+        like comments, history and attachments of many bugs.
+        Defaults to $PYTHONBUGZILLA_REQUESTS_CONCURRENCY or 4.
+        Set it to 1 to send them one after another.
+        """
+        if self._session:
+            return self._session.get_concurrency()
+        return self._requests_concurrency
+
+    def _set_requests_concurrency(self, val):
+        self._requests_concurrency = None if val is None else max(1, int(val))
+        if self._session:
+            self._session.set_concurrency(self._requests_concurrency)
+    requests_concurrency = property(_get_requests_concurrency,
+                                    _set_requests_concurrency)
+
+    def _get_getbugs_chunk_size(self):
+        """
+        Max number of bug ids and aliases getbugs() asks for in a single
+        request. Longer lists are fetched in chunks, requests_concurrency
+        at a time. A chunk that times out or is refused as too large is
+        split in two and retried, and the chunk size shrinks to match
+        for later calls. Set it to 0 to always send a single request.
+        """
+        return self._getbugs_chunk_size
+
+    def _set_getbugs_chunk_size(self, val):
+        self._getbugs_chunk_size = max(0, int(val))
+    getbugs_chunk_size = property(_get_getbugs_chunk_size,
+                                  _set_getbugs_chunk_size)
+
 
     def _getbug_extra_fields(self):
         """
@@ -1091,24 +1387,122 @@ class Bugzilla(object):
         getbugdata.update(self._process_include_fields(
             include_fields, exclude_fields, extra_fields))
 
-        r = self._backend.bug_get(ids, aliases, getbugdata)
+        if (self._bugcache and not aliases and "last_change_time" not in
+                (getbugdata.get("exclude_fields") or [])):
+            r = self._getbugs_cached(ids, getbugdata)
+        else:
+            aliasset = set(aliases)
+            r = {"bugs": self._fetch_chunked(ids + aliases,
+                lambda chunk: self._backend.bug_get(
+                    [i for i in chunk if i not in aliasset],
+                    [a for a in chunk if a in aliasset], getbugdata))}
 
         # Do some wrangling to ensure we return bugs in the same order
         # the were passed in, for historical reasons
+        byid = {}
+        byalias = {}
+        for bugdict in r["bugs"]:
+            byid.setdefault(bugdict.get("id", None), bugdict)
+            for a in listify(bugdict.get("alias", None) or []):
+                byalias.setdefault(a, bugdict)
+
         ret = []
         for idval in idlist:
             idint, alias = _alias_or_int(idval)
-            for bugdict in r["bugs"]:
-                if idint is not None and idint != bugdict.get("id", None):
-                    continue
-                aliaslist = listify(bugdict.get("alias", None) or [])
-                if alias and alias not in aliaslist:
-                    continue
-
+            if idint is not None:
+                bugdict = byid.get(idint)
+            else:
+                bugdict = byalias.get(alias)
+            if bugdict is not None:
                 ret.append(bugdict)
-                break
         return ret
 
+    def _fetch_chunked(self, items, fetch):
+        """
+        Return the 'bugs' of fetch(items), calling it on chunks of
+        getbugs_chunk_size items concurrently if items is longer.
+        The results keep the order of the chunks.
+        """
+        size = self._getbugs_chunk_size
+        if not size or len(items) <= size:
+            return fetch(items)["bugs"]
+
+        # Even chunks of 2 items or more: REST fetches a single id
+        # with its own non permissive API
+        nchunks = -(-len(items) // max(2, size))
+        chunks = [items[i * len(items) // nchunks:
+                        (i + 1) * len(items) // nchunks]
+                  for i in range(nchunks)]
+
+        def _fetch_one(chunk):
+            try:
+                return fetch(chunk)["bugs"]
+            except Exception as e:
+                if len(chunk) < 4 or not _is_oversize_error(e):
+                    raise
+            half = len(chunk) // 2
+            log.debug("Fetching %d bugs failed, retrying in chunks of %d",
+                      len(chunk), half)
+            self._getbugs_chunk_size = min(self._getbugs_chunk_size, half)
+            return _fetch_one(chunk[:half]) + _fetch_one(chunk[half:])
+
+        workers = min(self.requests_concurrency, len(chunks))
+        log.debug("Fetching %d bugs in %d chunks, %d at a time",
+                  len(items), len(chunks), workers)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="bzgetbugs") as pool:
+            return [b for bugs in pool.map(_fetch_one, chunks) for b in bugs]
+
+    def _getbugs_cached(self, ids, getbugdata):
+        """
+        bug_get() through the bug cache. Cached bugs are revalidated
+        with a single search for their last_change_time, and only
+        the changed and uncached ones are fetched in full.
+        """
+        signature = repr(sorted(getbugdata.items()))
+        include_fields = getbugdata.get("include_fields")
+        # last_change_time is needed for revalidation, but the
+        # caller didn't ask for it
+        strip_lct = bool(include_fields and
+                         "last_change_time" not in include_fields)
+        cached = {}
+        for bugid in ids:
+            data = self._bugcache.get((self.url, int(bugid), signature))
+            if data is not None:
+                cached[int(bugid)] = data
+
+        if cached:
+            current = dict((b["id"], b.get("last_change_time")) for b in
+                self._fetch_chunked(list(cached),
+                    lambda chunk: self._backend.bug_search({"id": chunk,
+                        "include_fields": ["id", "last_change_time"]})))
+            for bugid, data in list(cached.items()):
+                if current.get(bugid) != data.get("last_change_time"):
+                    del cached[bugid]
+            log.debug("Bug cache: %d of %d bugs still valid",
+                      len(cached), len(ids))
+
+        bugs = list(cached.values())
+        if strip_lct:
+            for bugdict in bugs:
+                bugdict.pop("last_change_time", None)
+        fetch = [bugid for bugid in ids if int(bugid) not in cached]
+        if not fetch:
+            return {"bugs": bugs}
+
+        fetchdata = getbugdata.copy()
+        if strip_lct:
+            fetchdata["include_fields"] = include_fields + ["last_change_time"]
+        for bugdict in self._fetch_chunked(fetch,
+                lambda chunk: self._backend.bug_get(chunk, [], fetchdata)):
+            if "last_change_time" in bugdict:
+                self._bugcache.put(
+                    (self.url, bugdict["id"], signature), bugdict)
+            if strip_lct:
+                bugdict.pop("last_change_time", None)
+            bugs.append(bugdict)
+        return {"bugs": bugs}
+
     def _getbug(self, objid, **kwargs):
         """
         Thin wrapper around _getbugs to handle the slight argument tweaks
@@ -1146,6 +1540,40 @@ class Bugzilla(object):
                            autorefresh=self.bug_autorefresh)) or None
                 for b in data]
 
+    def getbugs_batch(self, idlist,
+                      include_fields=None, exclude_fields=None,
+                      extra_fields=None):
+        """
+        Like getbug() for each id in idlist, but sent in as few requests
+        as the backend allows: one system.multicall on XMLRPC servers
+        supporting it, concurrent requests on REST.
+
+        Returns a list with, for each id, either a Bug object or the
+        exception getbug() would have raised for it.
+        """
+        getbugdata = {}
+        getbugdata.update(self._process_include_fields(
+            include_fields, exclude_fields,
+            listify(extra_fields or []) + self._getbug_extra_fields()))
+
+        calls = []
+        for idval in idlist:
+            if str(idval).isdigit():
+                calls.append(("bug_get", ([idval], [], getbugdata)))
+            else:
+                calls.append(("bug_get", ([], [str(idval)], getbugdata)))
+
+        ret = []
+        for r in self._backend.batch(calls):
+            if isinstance(r, Exception):
+                ret.append(r)
+            elif not r["bugs"]:
+                ret.append(BugzillaError("No bug returned"))
+            else:
+                ret.append(Bug(self, dict=r["bugs"][0],
+                               autorefresh=self.bug_autorefresh))
+        return ret
+
     def get_comments(self, idlist):
         """
         Returns a dictionary of bugs and comments.  The comments key will
@@ -1153,6 +1581,23 @@ class Bugzilla(object):
         """
         return self._backend.bug_comments(idlist, {})
 
+    def get_comments_attr(self, buglist):
+        """
+        Fetch the comments of every Bug in buglist and add them as the
+        'comments' attribute, like Bug.getcomments_attr() but with as few
+        API calls as the backend allows. None entries are skipped.
+        Returns buglist.
+        """
+        bugs = [b for b in buglist if b]
+        if not bugs:
+            return buglist
+
+        idlist = list(dict.fromkeys(b.bug_id for b in bugs))
+        comments = self.get_comments(idlist)["bugs"]
+        for b in bugs:
+            b._update_dict({"comments": comments[str(b.bug_id)]["comments"]})
+        return buglist
+
 
     #################
     # query methods #
@@ -1333,6 +1778,220 @@ class Bugzilla(object):
         return [Bug(self, dict=b,
                 autorefresh=self.bug_autorefresh) for b in r['bugs']]
 
+    def _query_pages(self, query, page_size, readahead=False, by_id=False):
+        """
+        Generator behind query_iter(), yielding the results of query
+        as lists of at most page_size Bug objects.
+
+        With by_id, the pages after the first one ask for the bugs with
+        an ID above the last one seen instead of using an offset, so a
+        bug leaving the results between two pages doesn't make the
+        next one be skipped.
+        """
+        if page_size < 1:
+            raise ValueError("page_size must be a positive number")
+        # limit=0 means no limit, as in url_to_query() output
+        total = int(query.get("limit") or 0)
+        offset = int(query.get("offset") or 0)
+        lastid = None
+        count = 0
+
+        def _pagequery():
+            size = page_size
+            if total:
+                size = min(size, total - count)
+            pagequery = query.copy()
+            if lastid is not None:
+                pagequery = self._query_add_range(
+                    query, "id", lastid + 1, None)
+            pagequery["order"] = "bug_id"
+            pagequery["limit"] = size
+            pagequery["offset"] = offset
+            return pagequery
+
+        executor = None
+        if readahead:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="bzquery")
+        future = None
+        try:
+            while True:
+                pagequery = _pagequery()
+                if pagequery["limit"] <= 0:
+                    return
+                if future:
+                    page = future.result()
+                else:
+                    page = self.query(pagequery)
+                if by_id and page:
+                    lastid = int(page[-1].id)
+                    offset = 0
+                else:
+                    offset += len(page)
+                count += len(page)
+
+                future = None
+                done = len(page) < pagequery["limit"]
+                if executor and not done:
+                    nextquery = _pagequery()
+                    if nextquery["limit"] > 0:
+                        future = executor.submit(self.query, nextquery)
+                if page:
+                    yield page
+                if done:
+                    return
+        finally:
+            if executor:
+                if future:
+                    future.cancel()
+                executor.shutdown(wait=False)
+
+    def query_iter(self, query, page_size=500, readahead=False):
+        """
+        Like query(), but fetch the results page by page with
+        limit/offset, ordered by bug ID, and yield the Bug objects as
+        the pages arrive. This avoids the caps servers put on the
+        number of results of a single search, and its timeouts.
+
+        A 'limit' and 'offset' already in query still apply to the
+        whole result set.
+
+        :param page_size: Number of bugs to request per search
+        :param readahead: If True, fetch the next page on a background
+            thread while the current one is consumed
+        """
+        for page in self._query_pages(query, page_size, readahead):
+            for bug in page:
+                yield bug
+
+    def _query_split_bounds(self, query, split_by):
+        # The lowest and highest bug ID or creation time matching query.
+        # Bug IDs grow with creation time, so both come from the
+        # first and last bug by ID.
+        field = split_by == "id" and "id" or "creation_time"
+        include_fields = sorted(set(["id", field]))
+        bounds = []
+        for order in ["bug_id", "bug_id DESC"]:
+            probe = query.copy()
+            probe.update({"order": order, "limit": 1,
+                          "include_fields": include_fields})
+            probe.pop("exclude_fields", None)
+            probe.pop("extra_fields", None)
+            bugs = self._backend.bug_search(probe)["bugs"]
+            if not bugs:
+                return None
+            bounds.append(bugs[0][field])
+        if split_by == "id":
+            return int(bounds[0]), int(bounds[1]) + 1
+        return (_parse_bug_time(bounds[0]),
+                _parse_bug_time(bounds[1]) + datetime.timedelta(seconds=1))
+
+    @staticmethod
+    def _query_add_range(query, split_by, start, end):
+        # Return a copy of query further limited to start <= value < end,
+        # using boolean chart conditions after the ones already in query.
+        # A None start or end leaves that side open.
+        if str(query.get("j_top", "AND")).upper() != "AND":
+            raise BugzillaError("Can't split a query whose conditions "
+                                "are joined with '%s'" % query["j_top"])
+        used = [int(m.group(1)) for m in
+                [re.match(r"^[fovnj](\d+)$", k) for k in query] if m]
+        idx = max(used + [0]) + 1
+        field = split_by == "id" and "bug_id" or "creation_ts"
+
+        query = query.copy()
+        for op, val in [("greaterthaneq", start), ("lessthan", end)]:
+            if val is None:
+                continue
+            if split_by != "id":
+                val = val.strftime("%Y-%m-%d %H:%M:%S")
+            query.update({"f%d" % idx: field, "o%d" % idx: op,
+                          "v%d" % idx: str(val)})
+            idx += 1
+        return query
+
+    def query_split(self, query, split_by="id", parts=None,
+                    max_workers=None, max_depth=6):
+        """
+        Run a huge query as many smaller ones, concurrently.
+
+        The range of bug IDs or creation times matching query is cut
+        into disjoint sub-ranges, each searched on its own. The first
+        and last ones are open-ended, so bugs outside the probed range
+        are not missed. A sub-query
+        that times out is split in two and retried, up to max_depth
+        times. Results are merged, deduplicated and sorted by bug ID.
+
+        :param split_by: 'id' for bug ID ranges, 'creation_time' for
+            creation time windows
+        :param parts: Number of sub-queries to start with. Defaults to
+            twice max_workers.
+        :param max_workers: Maximum number of sub-queries running at
+            once. Defaults to requests_concurrency.
+        :returns: List of Bug objects
+        """
+        if split_by not in ["id", "creation_time"]:
+            raise ValueError("split_by must be 'id' or 'creation_time'")
+        query = query.copy()
+        if str(query.get("limit", "0")) != "0" or query.get("offset"):
+            raise BugzillaError("Can't split a query using limit/offset")
+        query.pop("limit", None)
+        query.pop("offset", None)
+        max_workers = max_workers or self.requests_concurrency
+        parts = parts or max_workers * 2
+
+        bounds = self._query_split_bounds(query, split_by)
+        if not bounds:
+            return []
+        first, end = bounds
+        start = first
+        step = (end - start) / parts
+        if split_by == "id":
+            step = max(1, int(-(-(end - start) // parts)))
+        ranges = []
+        while start < end:
+            ranges.append((start, min(start + step, end), 0))
+            start += step
+
+        def _run(rng):
+            low, high = rng[0], rng[1]
+            return self.query(self._query_add_range(query, split_by,
+                low if low != first else None,
+                high if high != end else None))
+
+        bugs = {}
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers,
+                thread_name_prefix="bzsplit") as executor:
+            pending = dict((executor.submit(_run, r), r) for r in ranges)
+            while pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    rng = pending.pop(future)
+                    try:
+                        for bug in future.result():
+                            bugs[bug.bug_id] = bug
+                        continue
+                    except Exception as e:
+                        low, high, depth = rng
+                        mid = low + (high - low) / 2
+                        if split_by == "id":
+                            mid = low + (high - low) // 2
+                        if (not _is_timeout_error(e) or
+                                depth >= max_depth or mid <= low):
+                            for f in pending:
+                                f.cancel()
+                            raise
+                        log.debug("Sub-query %s-%s timed out, splitting it",
+                                  low, high)
+                    for sub in [(low, mid, depth + 1),
+                                (mid, high, depth + 1)]:
+                        pending[executor.submit(_run, sub)] = sub
+
+        log.debug("Split query returned %s bugs", len(bugs))
+        return [bugs[bugid] for bugid in sorted(bugs)]
+
     def pre_translation(self, query):
         """
         In order to keep the API the same, Bugzilla4 needs to process the
@@ -1836,15 +2495,7 @@ class Bugzilla(object):
                     rawusers.get('users', [])]
 
         # Return users in same order they were passed in
-        ret = []
-        for u in userlist:
-            for uobj in userobjs[:]:
-                if uobj.email == u:
-                    userobjs.remove(uobj)
-                    ret.append(uobj)
-                    break
-        ret += userobjs
-        return ret
+        return _order_like(userobjs, userlist, lambda u: u.email)
 
 
     def searchusers(self, pattern):
@@ -1957,15 +2608,7 @@ class Bugzilla(object):
         ]
 
         # Return in same order they were passed in
-        ret = []
-        for g in grouplist:
-            for gobj in groupobjs[:]:
-                if gobj.name == g:
-                    groupobjs.remove(gobj)
-                    ret.append(gobj)
-                    break
-        ret += groupobjs
-        return ret
+        return _order_like(groupobjs, grouplist, lambda g: g.name)
 
 
     #############################
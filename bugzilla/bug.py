@@ -6,12 +6,24 @@
 
 import copy
 from logging import getLogger
+import types
 from urllib.parse import urlparse, urlunparse
 
 
 log = getLogger(__name__)
 
 
+def _bug_alias_map(aliases):
+    """
+    Map each old name in a list of (newname, oldname) bug aliases to
+    the tuple of its new names, in list order
+    """
+    ret = {}
+    for newname, oldname in aliases:
+        ret[oldname] = ret.get(oldname, ()) + (newname,)
+    return types.MappingProxyType(ret)
+
+
 class Bug(object):
     """
     A container object for a bug report. Requires a Bugzilla instance -
@@ -22,16 +34,21 @@ class Bug(object):
                       you can read any attributes or make modifications to this
                       bug.
     """
+    # Object attributes that aren't bug fields
+    _NON_FIELD_NAMES = ["bugzilla", "autorefresh", "weburl"]
+
     def __init__(self, bugzilla, bug_id=None, dict=None, autorefresh=False):
         # pylint: disable=redefined-builtin
         # API had pre-existing issue that we can't change ('dict' usage)
 
         self.bugzilla = bugzilla
         self._rawdata = {}
+        self._weburl = None
         self.autorefresh = autorefresh
 
         # pylint: disable=protected-access
         self._aliases = self.bugzilla._get_bug_aliases()
+        self._aliasmap = self.bugzilla._get_bug_alias_map()
         # pylint: enable=protected-access
 
         if not dict:
@@ -40,7 +57,20 @@ class Bug(object):
             dict["id"] = bug_id
 
         self._update_dict(dict)
-        self.weburl = self._generate_weburl()
+
+    def _get_weburl(self):
+        """
+        URL to the bug in the web UI, generated on first use
+        """
+        if self._weburl is None and self.bugzilla:
+            self._weburl = self._generate_weburl()
+        if self._weburl is None:
+            raise AttributeError("weburl")
+        return self._weburl
+
+    def _set_weburl(self, val):
+        self._weburl = val
+    weburl = property(_get_weburl, _set_weburl)
 
     def _generate_weburl(self):
         """
@@ -71,16 +101,23 @@ class Bug(object):
         return '<Bug #%i on %s at %#x>' % (self.bug_id, url, id(self))
 
     def __getattr__(self, name):
+        # Bug fields are only stored in _rawdata, __dict__ just has
+        # the ones explicitly assigned to the object
+        rawdata = self.__dict__.get("_rawdata")
+        if rawdata is None:
+            # Not initialized yet, like while unpickling
+            raise AttributeError(name)
+
         refreshed = False
         while True:
-            if refreshed and name in self.__dict__:
-                # If name was in __dict__ to begin with, __getattr__ would
-                # have never been called.
-                return self.__dict__[name]
+            if name in rawdata:
+                return rawdata[name]
 
-            for newname, oldname in self._aliases:
-                if name == oldname and newname in self.__dict__:
+            for newname in self._aliasmap.get(name, ()):
+                if newname in self.__dict__:
                     return self.__dict__[newname]
+                if newname in rawdata:
+                    return rawdata[newname]
 
             # Doing dir(bugobj) does getattr __members__/__methods__,
             # don't refresh for those
@@ -116,6 +153,28 @@ class Bug(object):
         """
         return copy.deepcopy(self._rawdata)
 
+    def get_raw_data_view(self):
+        """
+        Return a read-only view of the raw API dictionary data of this
+        bug, without copying it. Use it for serializing, and
+        get_raw_data() to get data that can be modified.
+        """
+        return types.MappingProxyType(self._rawdata)
+
+    def _get_attributes(self):
+        """
+        Return a dict of all attributes of this bug, like __dict__ was
+        when every field was also stored there
+        """
+        ret = self._rawdata.copy()
+        ret.update(self.__dict__)
+        ret.pop("_weburl", None)
+        try:
+            ret["weburl"] = self.weburl
+        except AttributeError:
+            pass
+        return ret
+
     def refresh(self, include_fields=None, exclude_fields=None,
         extra_fields=None):
         """
@@ -134,6 +193,9 @@ class Bug(object):
         if self.bugzilla:
             self.bugzilla.post_translation({}, newdict)
 
+        if not any(key in self._aliasmap for key in newdict):
+            return
+
         for newname, oldname in self._aliases:
             if oldname not in newdict:
                 continue
@@ -155,9 +217,12 @@ class Bug(object):
         """
         self._translate_dict(newdict)
         self._rawdata.update(newdict)
-        self.__dict__.update(newdict)
+        # New values replace ones assigned to the object before
+        for key in newdict:
+            if key not in self._NON_FIELD_NAMES:
+                self.__dict__.pop(key, None)
 
-        if 'id' not in self.__dict__ and 'bug_id' not in self.__dict__:
+        if 'id' not in self._rawdata and 'bug_id' not in self._rawdata:
             raise TypeError("Bug object needs a bug_id")
 
 
@@ -172,8 +237,10 @@ class Bug(object):
 
     def __setstate__(self, vals):
         self._rawdata = {}
+        self._weburl = None
         self.bugzilla = None
         self._aliases = vals.get("_aliases", [])
+        self._aliasmap = _bug_alias_map(self._aliases)
         self.autorefresh = False
         self._update_dict(vals)
 
@@ -380,7 +447,7 @@ class Bug(object):
         Helper call to Bugzilla.get_attachments. If you want to fetch
         specific attachment IDs, use that function instead
         """
-        if "attachments" in self.__dict__:
+        if "attachments" in self.__dict__ or "attachments" in self._rawdata:
             return self.attachments
 
         data = self.bugzilla.get_attachments([self.bug_id], None,
@@ -41,3 +41,10 @@ class BugzillaError(Exception):
 
 class BugzillaHTTPError(HTTPError):
     """Error raised in the Bugzilla session"""
+
+
+class BugzillaCircuitOpenError(BugzillaError):
+    """
+    Error raised without contacting the server, because too many
+    requests to its host failed in a row recently
+    """